@@ -0,0 +1,193 @@
+# Benchmarks of the bot's hot paths
+#
+# Usage:
+#   python benchmark.py parse [--bbc page.html] [--guardian page.html] [--runs 20]
+#   python benchmark.py render [--articles 12] [--recipients 10000] [--runs 5]
+#   python benchmark.py explain
+#
+# Pages which are not given as files are downloaded from the live websites.
+
+import argparse
+import os
+import sys
+import time
+import tracemalloc
+
+os.environ.setdefault("TELEGRAM_BOT_TOKEN", "0:benchmark") # main.py creates a Bot when imported
+
+from bs4 import BeautifulSoup
+import httpx
+
+import main
+
+
+# Function to run `func` several times and return (mean seconds, peak traced bytes, last result)
+def measure(func, runs):
+    func() # Warming up
+    started = time.perf_counter()
+    for _ in range(runs):
+        result = func()
+    elapsed = (time.perf_counter() - started) / runs
+    tracemalloc.start()
+    func()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return elapsed, peak, result
+
+
+# Function to print one comparison line
+def report(name, elapsed, peak, count):
+    print(f"{name:<42} {elapsed * 1000:9.2f} ms {peak / 1024 / 1024:9.2f} MiB {count:5d} articles")
+
+
+#                                               PARSING
+
+# The parsers as they were before lxml and SoupStrainer: full html.parser tree of the page
+def baseline_parse_bbc(content):
+    articles = []
+    soup = BeautifulSoup(content, 'html.parser')
+    articles_list = soup.find_all('ul', {'class': 'ssrcss-y8stko-Grid e12imr580'})
+    if articles_list:
+        for li in articles_list[0].find_all('li'):
+            link = li.find('a', href=True)
+            if link and link['href'].startswith('/'):
+                title_element = li.find('p')
+                subject_element = li.find('span', {'class': 'ssrcss-1pvwv4b-MetadataSnippet e4wm5bw3'})
+                time_element = li.find('span', {'class': 'visually-hidden ssrcss-1f39n02-VisuallyHidden e16en2lz0'})
+                if title_element:
+                    articles.append(main.Article(title_element.text,
+                                                 subject_element.text if subject_element else "Unknown",
+                                                 time_element.text if time_element else "No Time",
+                                                 f"https://www.bbc.co.uk{link['href']}"))
+                    if len(articles) >= 6:
+                        break
+    return articles
+
+def baseline_parse_guardian(content):
+    articles = []
+    soup = BeautifulSoup(content, 'html.parser')
+    articles_list = soup.find_all('ul', {'class': 'dcr-68r5kg'})
+    if articles_list:
+        for li in articles_list[0].find_all('li'):
+            link = li.find('a', href=True)
+            if link and link['href'].startswith('/'):
+                subject_element = li.find('div', {'class': 'dcr-1cc5b8d'})
+                time_element = li.find('time')
+                articles.append(main.Article(link.get('aria-label') or "No Title",
+                                             subject_element.text if subject_element else "Unknown",
+                                             time_element.text if time_element else "No Time",
+                                             f"https://www.theguardian.com{link['href']}"))
+                if len(articles) >= 6:
+                    break
+    return articles
+
+
+# Function to read a saved page or download the live one
+def load_page(path, url):
+    if path:
+        with open(path, "rb") as file:
+            return file.read()
+    return httpx.get(url, follow_redirects=True, timeout=30).content
+
+
+def bench_parse(args):
+    pages = [
+        ("BBC", load_page(args.bbc, main.NEWS_SOURCES["BBC"].url), baseline_parse_bbc),
+        ("The Guardian", load_page(args.guardian, main.NEWS_SOURCES["The Guardian"].url), baseline_parse_guardian),
+    ]
+    print(f"Parser backend: {main.HTML_PARSER}, {args.runs} runs each")
+    for name, content, baseline in pages:
+        print(f"\n{name} ({len(content) / 1024:.0f} KiB)")
+        elapsed, peak, result = measure(lambda: baseline(content), args.runs)
+        report("html.parser, full tree (before)", elapsed, peak, len(result))
+        elapsed, peak, (result, problem) = measure(lambda: main.parse_articles(name, content), args.runs)
+        report(f"{main.HTML_PARSER}, article list only (now)", elapsed, peak, len(result))
+        if problem is not None:
+            print(f"  {problem}")
+
+
+#                                               RENDERING
+
+# The escaper and message building as they were before the translate tables and templates
+def baseline_escape_markdownv2(text):
+    escape_chars = '_*[]()~`>#+-=|{}.!'
+    return ''.join(f'\\{char}' if char in escape_chars else char for char in text)
+
+def baseline_render(articles, recipients):
+    messages = []
+    for article in articles:
+        message = (
+            f"*{baseline_escape_markdownv2(article.title)}*\n"
+            f"_Subject: {baseline_escape_markdownv2(article.subject)}_\n"
+            f"_Publication time: {baseline_escape_markdownv2(article.publicationTime)}_\n"
+            f"[Read Article]({baseline_escape_markdownv2(article.link)})\n"
+            f"{baseline_escape_markdownv2(article.source)}"
+        )
+        for realname in recipients:
+            messages.append(f"{realname}, this article may be interesting for you\\.\n" + message)
+    return messages
+
+def current_render(articles, recipients):
+    messages = []
+    for article in articles:
+        message = main.render_article(article)
+        for realname in recipients:
+            messages.append(main.render_greeting(realname, "this article may be interesting for you.") + "\n" + message)
+    return messages
+
+
+def bench_render(args):
+    articles = [
+        main.Article(f"Minister says talks on the 2024-25 budget (part {number}) will resume next week.",
+                     "UK Politics", f"{number}h ago",
+                     f"https://www.bbc.co.uk/news/uk-politics-{6800000 + number}", "BBC")
+        for number in range(args.articles)
+    ]
+    recipients = [f"Reader {number}" for number in range(args.recipients)]
+    print(f"{args.articles} articles x {args.recipients} recipients, {args.runs} runs each")
+    for name, escape in (("generator escaper (before)", baseline_escape_markdownv2), ("escape table (now)", main.escape_markdownv2)):
+        elapsed, _, _ = measure(lambda: [escape(article.title) for article in articles], args.runs * 100)
+        print(f"{name:<42} {elapsed / len(articles) * 1e6:9.2f} us per title")
+    elapsed, peak, result = measure(lambda: baseline_render(articles, recipients), args.runs)
+    print(f"{'render per article (before)':<42} {elapsed * 1000:9.2f} ms {peak / 1024 / 1024:9.2f} MiB {len(result):7d} messages")
+    elapsed, peak, result = measure(lambda: current_render(articles, recipients), args.runs)
+    print(f"{'template once, greeting per user (now)':<42} {elapsed * 1000:9.2f} ms {peak / 1024 / 1024:9.2f} MiB {len(result):7d} messages")
+
+
+#                                               QUERY PLANS
+
+def bench_explain(args):
+    main.migrate_database()
+    problems = main.check_query_plans()
+    for problem in problems:
+        print(problem)
+    print(f"{len(main.HOT_QUERIES)} hot queries checked, {len(problems)} problems")
+    if problems:
+        sys.exit(1)
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description="Benchmarks of the bot's hot paths")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    parse = commands.add_parser("parse", help="parse time and peak memory per front page")
+    parse.add_argument("--bbc", help="saved BBC front page")
+    parse.add_argument("--guardian", help="saved Guardian front page")
+    parse.add_argument("--runs", type=int, default=20)
+    parse.set_defaults(func=bench_parse)
+
+    render = commands.add_parser("render", help="escaping and message building time for one news cycle")
+    render.add_argument("--articles", type=int, default=12)
+    render.add_argument("--recipients", type=int, default=10000)
+    render.add_argument("--runs", type=int, default=5)
+    render.set_defaults(func=bench_render)
+
+    explain = commands.add_parser("explain", help="check that the hot queries can use their indexes (needs the database from .env)")
+    explain.set_defaults(func=bench_explain)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main_cli()
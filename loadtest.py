@@ -0,0 +1,528 @@
+# Offline load test of the news cycle and the command handlers
+#
+# Usage:
+#   python loadtest.py seed --users 10000 [--sessions 1.0] [--preferences 3] [--mode digest]
+#   python loadtest.py run [--cycles 3] [--new-articles 6] [--commands 2000] [--flood-every 500] [--bbc page.html] [--guardian page.html]
+#   python loadtest.py webhook --secret SECRET [--url http://127.0.0.1:8443/telegram] [--updates 10000] [--rate 500]
+#   python loadtest.py ledger [--articles 12] [--recipients 100000] [--mode digest] [--chunk 2000]
+#
+# Nothing leaves the machine: Telegram is replaced by a stub Bot API server which records every message and
+# can answer with flood-limit errors, and the news sites by synthetic front pages (or saved ones) served by the same server.
+# The database is LOADTEST_DB_NAME (news_loadtest by default) on the server from .env; it has to exist, and `seed` empties it.
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+import time
+from types import SimpleNamespace
+from urllib.parse import parse_qs
+
+STUB_HOST = "127.0.0.1"
+STUB_PORT = int(os.getenv("LOADTEST_STUB_PORT", "18081"))
+STUB_TOKEN = "0:loadtest"
+
+# main.py reads its settings when imported, so they are pointed at the stubs first
+os.environ["TELEGRAM_BOT_TOKEN"] = STUB_TOKEN
+os.environ["TELEGRAM_API_BASE_URL"] = f"http://{STUB_HOST}:{STUB_PORT}/bot"
+os.environ["DB_NAME"] = os.getenv("LOADTEST_DB_NAME", "news_loadtest")
+os.environ["ROLE"] = "all" # Fan-out and sending run in this process
+os.environ.setdefault("TELEGRAM_GLOBAL_RATE", "1000") # The stub has no global limit, flood errors are injected instead
+os.environ.setdefault("METRICS_PORT", "0")
+
+import bcrypt
+import httpx
+from telegram import Update
+
+import main
+
+
+SUBJECTS = [
+    "UK", "World", "Business", "Politics", "Technology", "Science", "Health", "Education", "Entertainment", "Sport",
+    "Football", "Climate", "Money", "Culture", "Environment", "Opinion", "Lifestyle", "Travel", "Europe", "US & Canada",
+]
+
+
+#                                               SEEDED DATABASE
+
+# Tables emptied before seeding, children first
+SEEDED_TABLES = ["delivery_jobs", "deliveries", "failed_deliveries", "user_preferences", "username_telegramID", "users",
+                 "articles", "seen_links", "subjects"]
+
+# Function to insert rows in batches
+def insert_many(cursor, query, rows, batch=5000):
+    for start in range(0, len(rows), batch):
+        cursor.executemany(query, rows[start:start + batch])
+
+def seed(args):
+    main.migrate_database()
+    generator = random.Random(args.seed)
+    password_hash = bcrypt.hashpw(b"loadtest", bcrypt.gensalt(rounds=4)) # Every user shares one cheap hash
+    users = [(f"user{number}", f"Reader {number}", password_hash, args.mode) for number in range(args.users)]
+    sessions = [(10_000_000 + number, f"user{number}") for number in range(args.users) if generator.random() < args.sessions]
+    with main.db_connection() as connection:
+        cursor = connection.cursor()
+        cursor.execute("SET FOREIGN_KEY_CHECKS = 0")
+        for table in SEEDED_TABLES:
+            cursor.execute(f"TRUNCATE TABLE {table}")
+        cursor.execute("SET FOREIGN_KEY_CHECKS = 1")
+        connection.start_transaction()
+        insert_many(cursor, "INSERT INTO subjects (name) VALUES (%s)", [(subject,) for subject in SUBJECTS])
+        cursor.execute("SELECT id FROM subjects")
+        subject_ids = [row[0] for row in cursor.fetchall()]
+        preferences = [(username, subject_id) for username, _, _, _ in users
+                       for subject_id in generator.sample(subject_ids, min(args.preferences, len(subject_ids)))]
+        insert_many(cursor, "INSERT INTO users (username, realname, password_hash, delivery_mode) VALUES (%s, %s, %s, %s)", users)
+        insert_many(cursor, "INSERT INTO username_telegramID (telegram_id, username) VALUES (%s, %s)", sessions)
+        insert_many(cursor, "INSERT INTO user_preferences (username, subject_id) VALUES (%s, %s)", preferences)
+        connection.commit()
+        cursor.close()
+    print(f"Seeded {len(users)} users, {len(sessions)} sessions and {len(preferences)} preferences into {os.environ['DB_NAME']}")
+
+
+#                                               STUB SERVER
+
+# Synthetic front pages in the layout the source declarations expect, newest article first.
+# Every cycle moves the window by `new` articles, so each check finds exactly that many new ones.
+# With `lead`, story 0 stays on top of every page the way a curated front page keeps its lead story for hours,
+# and the new stories appear below it
+def synthetic_item(source, number):
+    subject = SUBJECTS[number % len(SUBJECTS)]
+    if source.name == "BBC":
+        return (f'<li><a href="/news/articles/loadtest{number}"><p>Load test headline {number} (part {number % 7}).</p></a>'
+                f'<span class="ssrcss-1pvwv4b-MetadataSnippet e4wm5bw3">{subject}</span>'
+                f'<span class="visually-hidden ssrcss-1f39n02-VisuallyHidden e16en2lz0">{number % 24} hours ago</span></li>')
+    return (f'<li><a href="/uk-news/2026/loadtest-{number}" aria-label="Load test story {number}, with details."></a>'
+            f'<div class="dcr-1cc5b8d">{subject}</div><time>{number % 24:02d}.00</time></li>')
+
+def synthetic_page(source, cycle, new, lead=True, listed=30, padding_kib=300):
+    newest = (cycle + 1) * new
+    numbers = ([0] if lead else []) + list(range(newest, max(0, newest - listed), -1))
+    items = "".join(synthetic_item(source, number) for number in numbers)
+    filler = '<div class="filler"><p>Unrelated markup around the article list.</p></div>' * (padding_kib * 1024 // 64)
+    return (f'<html><head><title>{source.name}</title></head><body>{filler[:len(filler) // 2]}'
+            f'<ul class="{source.list_class}">{items}</ul>{filler[len(filler) // 2:]}</body></html>').encode()
+
+# Local server answering the Bot API calls of the bot and serving the front pages
+class StubServer:
+    def __init__(self, flood_every=0, retry_after=1):
+        self.flood_every = flood_every # Every n-th sendMessage gets a 429 with retry_after, 0 never
+        self.retry_after = retry_after
+        self.pages = {} # Path -> page
+        self.calls = 0
+        self.sent = [] # (chat id, text) of every accepted message
+        self.flood_errors = 0
+        self.server = None
+
+    async def start(self):
+        self.server = await asyncio.start_server(self._serve, STUB_HOST, STUB_PORT)
+
+    async def stop(self):
+        self.server.close()
+        await self.server.wait_closed()
+
+    def reset(self):
+        self.calls = 0
+        self.sent = []
+        self.flood_errors = 0
+
+    # Serves requests of one keep-alive connection
+    async def _serve(self, reader, writer):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                method, path, _ = request_line.decode("latin-1").split(" ", 2)
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get("content-length", "0")))
+                status, content_type, payload = self._answer(method, path, headers, body)
+                writer.write(f"HTTP/1.1 {status}\r\nContent-Type: {content_type}\r\nContent-Length: {len(payload)}\r\n\r\n".encode() + payload)
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    def _answer(self, method, path, headers, body):
+        if method == "GET" and path in self.pages:
+            return "200 OK", "text/html; charset=utf-8", self.pages[path]
+        if not path.startswith(f"/bot{STUB_TOKEN}/"):
+            return "404 Not Found", "text/plain", b"Not found\n"
+        api_method = path.rsplit("/", 1)[1]
+        if headers.get("content-type", "").startswith("application/json"):
+            parameters = json.loads(body or b"{}")
+        else:
+            parameters = {key: values[0] for key, values in parse_qs(body.decode()).items()}
+        if api_method == "getMe":
+            return self._result({"id": 1, "is_bot": True, "first_name": "Stub", "username": "stub_bot"})
+        if api_method == "sendMessage":
+            self.calls += 1
+            if self.flood_every and self.calls % self.flood_every == 0:
+                self.flood_errors += 1
+                return "429 Too Many Requests", "application/json", json.dumps({
+                    "ok": False, "error_code": 429, "description": f"Too Many Requests: retry after {self.retry_after}",
+                    "parameters": {"retry_after": self.retry_after},
+                }).encode()
+            chat_id = int(parameters["chat_id"])
+            text = str(parameters.get("text", ""))
+            self.sent.append((chat_id, text))
+            return self._result({"message_id": len(self.sent), "date": int(time.time()),
+                                 "chat": {"id": chat_id, "type": "private"}, "text": text})
+        return self._result(True)
+
+    def _result(self, result):
+        return "200 OK", "application/json", json.dumps({"ok": True, "result": result}).encode()
+
+
+#                                               COMMAND WORKLOAD
+
+COMMANDS = ["/start", "/info", "/preferences", "/add {subject}", "/remove {subject}", "/delivery digest"]
+
+# Function to build an update as Telegram would send it for a message of the given chat
+def update_data(update_id, telegram_id, text):
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": int(time.time()),
+            "chat": {"id": telegram_id, "type": "private"},
+            "from": {"id": telegram_id, "is_bot": False, "first_name": "Reader"},
+            "text": text,
+        },
+    }
+
+def command_update(update_id, telegram_id, text):
+    return Update.de_json(update_data(update_id, telegram_id, text), main.bot)
+
+# Function to run `count` random commands of seeded users, `concurrency` at a time.
+# Returns command -> seconds per call and command -> calls which raised (a flood error on the reply, for example)
+async def run_commands(count, concurrency, users, generator):
+    handlers = {"/start": main.start, "/info": main.info, "/preferences": main.preferences,
+                "/add": main.add, "/remove": main.remove, "/delivery": main.delivery}
+    timings = {}
+    errors = {}
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def one(update_id):
+        text = generator.choice(COMMANDS).format(subject=generator.choice(SUBJECTS))
+        command = text.split()[0]
+        update = command_update(update_id, 10_000_000 + generator.randrange(users), text)
+        context = SimpleNamespace(args=text.split()[1:], user_data={}, bot=main.bot)
+        async with semaphore:
+            started = time.perf_counter()
+            try:
+                await handlers[command](update, context)
+            except Exception:
+                errors[command] = errors.get(command, 0) + 1
+            timings.setdefault(command, []).append(time.perf_counter() - started)
+
+    await asyncio.gather(*(one(update_id) for update_id in range(count)))
+    return timings, errors
+
+# Function to return the exact percentile of a list of values
+def percentile(values, percent):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * percent / 100))]
+
+
+#                                               LOAD TEST
+
+# Function to read the number of statements the MySQL server has executed so far
+def server_questions():
+    with main.db_connection() as connection:
+        cursor = connection.cursor()
+        cursor.execute("SHOW GLOBAL STATUS LIKE 'Questions'")
+        questions = int(cursor.fetchone()[1])
+        cursor.close()
+    return questions
+
+# Function to read the number of calls of every blocking function so far
+def blocking_calls():
+    return {labels[0]: histogram.count for labels, histogram in list(main.blocking_call_seconds.children.items())}
+
+async def run_load_test(args):
+    stub = StubServer(args.flood_every)
+    await stub.start()
+    saved_pages = {"BBC": args.bbc, "The Guardian": args.guardian}
+    for name, source in main.NEWS_SOURCES.items():
+        source.url = f"http://{STUB_HOST}:{STUB_PORT}/pages/{name.replace(' ', '-').lower()}"
+    await main.bot.initialize()
+    main.delivery_queue.start()
+    consumer = asyncio.create_task(main.job_consumer.run())
+    generator = random.Random(args.seed)
+    users = len(main.subscription_index)
+    print(f"{users} sessions, {len(main.NEWS_SOURCES)} sources, {args.cycles} cycles, parser {main.HTML_PARSER}, "
+          f"{main.PARSE_WORKERS} parse processes")
+    try:
+        for cycle in range(args.cycles):
+            for name, source in main.NEWS_SOURCES.items():
+                path = source.url.split(str(STUB_PORT), 1)[1]
+                if saved_pages.get(name):
+                    with open(saved_pages[name], "rb") as file:
+                        stub.pages[path] = file.read()
+                else:
+                    stub.pages[path] = synthetic_page(source, cycle, args.new_articles, args.lead_story)
+            stub.reset()
+            questions, calls = server_questions(), blocking_calls()
+            started = time.perf_counter()
+            cycle_task = asyncio.create_task(main.print_latest_news())
+            # Commands run while the cycle is going, the way users hit the bot during a news check
+            timings, errors = await run_commands(args.commands, args.concurrency, users, generator) if args.commands and users else ({}, {})
+            results = await cycle_task
+            elapsed = time.perf_counter() - started
+            queries = server_questions() - questions - 1 # The SHOW STATUS itself counts as one
+            dao_calls = {name: count - calls.get(name, 0) for name, count in blocking_calls().items() if count > calls.get(name, 0)}
+
+            print(f"\nCycle {cycle + 1}: {elapsed:.2f} s, new articles per source {results}")
+            expected = args.new_articles + (1 if cycle == 0 and args.lead_story else 0)
+            synthetic = [result for name, result in zip(main.NEWS_SOURCES, results) if not saved_pages.get(name)]
+            if any(result != expected for result in synthetic):
+                print(f"  WARNING: the synthetic pages have {expected} new articles each, some were missed")
+            print(f"  messages: {len(stub.sent)} sent to {len({chat_id for chat_id, _ in stub.sent})} chats, "
+                  f"{stub.flood_errors} flood errors injected, {main.delivery_queue.stats()['failed']} failed so far")
+            print(f"  database: {queries} statements, blocking calls {dict(sorted(dao_calls.items()))}")
+            for command, values in sorted(timings.items()):
+                print(f"  {command:<12} {len(values):6d} calls  p50 {percentile(values, 50) * 1000:8.2f} ms  "
+                      f"p99 {percentile(values, 99) * 1000:8.2f} ms  {errors.get(command, 0)} errors")
+    finally:
+        consumer.cancel()
+        await asyncio.gather(consumer, return_exceptions=True)
+        await main.delivery_queue.stop()
+        await main.job_consumer.stop()
+        await main.close_http_client()
+        await main.bot.shutdown()
+        await stub.stop()
+
+# Tables of a previous run, emptied so every run finds the same articles new
+RUN_TABLES = ["delivery_jobs", "deliveries", "failed_deliveries", "articles", "seen_links"]
+
+# Function to empty the tables of a previous run
+def clear_tables(tables):
+    with main.db_connection() as connection:
+        cursor = connection.cursor()
+        for table in tables:
+            cursor.execute(f"DELETE FROM {table}")
+        cursor.close()
+
+def run(args):
+    main.migrate_database()
+    clear_tables(RUN_TABLES)
+    main.rebuild_subscription_index()
+    main.warm_seen_links()
+    try:
+        asyncio.run(run_load_test(args))
+    finally:
+        main.db_executor.shutdown()
+        main.news_executor.shutdown()
+        main.parse_executor.shutdown()
+        main.password_executor.shutdown()
+        main.db_pool.close()
+
+
+#                                               DELIVERY LEDGER
+
+TELEGRAM_MESSAGE_RATE = 30 # Messages per second Telegram lets one bot send, the ceiling every sender shares
+
+# Function to print one throughput line
+def report_rate(name, elapsed, rows, jobs):
+    print(f"  {name:<34} {elapsed:8.2f} s  {rows / elapsed:10.0f} ledger rows/s  {jobs / elapsed:9.0f} jobs/s")
+
+# Times the ledger's writes for one news cycle of `articles` new articles going to `recipients` sessions, without sending:
+# publishing the fan-out, publishing it again the way a resumed run would, and finishing every job the way the senders do
+def ledger(args):
+    main.migrate_database()
+    clear_tables(RUN_TABLES)
+    main.warm_seen_links()
+    articles = main.insert_articles([
+        main.Article(f"Ledger headline {number} (part {number % 7}).", SUBJECTS[number % len(SUBJECTS)], f"{number % 24} hours ago",
+                     f"https://www.bbc.co.uk/news/articles/ledger{time.time_ns()}-{number}", "BBC")
+        for number in range(args.articles)
+    ])
+    main.FAN_OUT_CHUNK = args.chunk
+    print(f"{len(articles)} articles x {args.recipients} recipients in {args.mode} mode, {args.chunk} sessions per transaction, "
+          f"{len(main.get_unpublished_articles())} articles waiting for their fan-out")
+    rendered = [(article.id, main.render_article(article)) for article in articles]
+    telegram_ids = range(10_000_000, 10_000_000 + args.recipients)
+    if args.mode == "instant":
+        jobs = [(telegram_id, main.render_greeting(f"Reader {telegram_id}", "this article may be interesting for you.") + "\n" + message, [article_id])
+                for telegram_id in telegram_ids for article_id, message in rendered]
+    else:
+        jobs = [job for telegram_id in telegram_ids for job in main.digest_jobs(
+            telegram_id, f"Reader {telegram_id}", rendered, "this article may be interesting for you.", "these articles may be interesting for you.")]
+    rows = sum(len(article_ids) for _, _, article_ids in jobs)
+    article_ids = [article.id for article in articles]
+
+    started = time.perf_counter()
+    published = main.publish_fan_out(article_ids, jobs, [])
+    report_rate("publish fan-out", time.perf_counter() - started, rows, len(jobs))
+    if published:
+        sys.exit(f"{len(published)} articles were published before the benchmark, empty {os.environ['DB_NAME']} and try again")
+
+    # A resumed or retried fan-out of the same articles has to be refused without writing anything
+    started = time.perf_counter()
+    published = main.publish_fan_out(article_ids, jobs, [])
+    jobs_after_replay = main.count_jobs()
+    print(f"  {'publish the same fan-out again':<34} {time.perf_counter() - started:8.2f} s  refused for {len(published)} articles, "
+          f"{jobs_after_replay - len(jobs)} extra jobs")
+
+    started = time.perf_counter()
+    finished = 0
+    shards = list(range(main.JOB_SHARDS))
+    while True:
+        claimed = main.claim_jobs(shards, main.JOB_BATCH, main.JOB_LEASE)
+        if not claimed:
+            break
+        main.finish_jobs([job_id for job_id, _, _, _ in claimed])
+        finished += len(claimed)
+    report_rate("claim and finish", time.perf_counter() - started, rows, finished)
+
+    with main.db_connection() as connection:
+        cursor = connection.cursor()
+        cursor.execute("SELECT status, COUNT(*) FROM deliveries GROUP BY status")
+        statuses = dict(cursor.fetchall())
+        cursor.close()
+    print(f"  ledger: {statuses.get(main.DELIVERY_SENT, 0)} sent, {statuses.get(main.DELIVERY_QUEUED, 0)} still queued, "
+          f"{main.count_jobs()} jobs left")
+    print(f"Sending {len(jobs)} messages takes {len(jobs) / TELEGRAM_MESSAGE_RATE:.0f} s at Telegram's {TELEGRAM_MESSAGE_RATE} messages/s")
+    main.close_resources()
+
+
+#                                               WEBHOOK
+
+# Function to wait until something listens on the address of a URL
+async def wait_for_listener(url, timeout):
+    address = httpx.URL(url)
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            _, writer = await asyncio.open_connection(address.host, address.port or 80)
+            writer.close()
+            return True
+        except OSError:
+            if time.monotonic() > deadline:
+                return False
+            await asyncio.sleep(0.5)
+
+# Stands in for Telegram: POSTs synthetic /start updates to the bot's webhook at a fixed rate
+# and counts the replies the bot sends back to the stub Bot API
+async def run_webhook_test(args):
+    stub = StubServer()
+    await stub.start()
+    print("Start the bot against the stubs with:")
+    print(f"  TELEGRAM_BOT_TOKEN={STUB_TOKEN} TELEGRAM_API_BASE_URL={os.environ['TELEGRAM_API_BASE_URL']} DB_NAME={os.environ['DB_NAME']} "
+          f"ROLE=bot UPDATE_MODE=webhook WEBHOOK_URL={args.url} WEBHOOK_SECRET={args.secret} python main.py")
+    try:
+        if not await wait_for_listener(args.url, args.wait):
+            print(f"Nothing listens on {args.url} after {args.wait} seconds")
+            return
+        await asyncio.sleep(1) # Letting the bot finish its start-up calls
+        stub.reset()
+        generator = random.Random(args.seed)
+        statuses = {}
+        latencies = []
+        semaphore = asyncio.Semaphore(args.concurrency)
+        async with httpx.AsyncClient(limits=httpx.Limits(max_connections=args.concurrency)) as client:
+            async def post(update_id, secret):
+                data = update_data(update_id, 10_000_000 + generator.randrange(args.users), "/start")
+                async with semaphore:
+                    started = time.perf_counter()
+                    try:
+                        response = await client.post(args.url, json=data, headers={"X-Telegram-Bot-Api-Secret-Token": secret}, timeout=30)
+                        status = response.status_code
+                    except httpx.HTTPError as e:
+                        status = type(e).__name__
+                    latencies.append(time.perf_counter() - started)
+                statuses[status] = statuses.get(status, 0) + 1
+
+            # A few requests with a wrong secret, which the bot has to refuse
+            rejected = {}
+            for update_id in range(args.bad_secret):
+                response = await client.post(args.url, json=update_data(update_id, 1, "/start"), headers={"X-Telegram-Bot-Api-Secret-Token": "wrong"})
+                rejected[response.status_code] = rejected.get(response.status_code, 0) + 1
+
+            started = time.perf_counter()
+            tasks = []
+            for update_id in range(args.bad_secret, args.bad_secret + args.updates):
+                delay = started + (update_id - args.bad_secret) / args.rate - time.perf_counter()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                tasks.append(asyncio.create_task(post(update_id, args.secret)))
+            await asyncio.gather(*tasks)
+            posted = time.perf_counter() - started
+
+        accepted = statuses.get(200, 0)
+        while len(stub.sent) < accepted and time.perf_counter() - started < posted + args.timeout:
+            await asyncio.sleep(0.1)
+        answered = time.perf_counter() - started
+
+        print(f"Wrong secret: {rejected}")
+        print(f"Posted {args.updates} updates in {posted:.2f} s ({args.updates / posted:.0f}/s), responses {statuses}")
+        print(f"  POST latency p50 {percentile(latencies, 50) * 1000:.2f} ms, p99 {percentile(latencies, 99) * 1000:.2f} ms")
+        print(f"  {len(stub.sent)} replies of {accepted} accepted updates after {answered:.2f} s ({len(stub.sent) / answered:.0f}/s)")
+    finally:
+        await stub.stop()
+
+def webhook(args):
+    asyncio.run(run_webhook_test(args))
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description="Offline load test with a stub Telegram API and a seeded database")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    seed_parser = commands.add_parser("seed", help="empty the load test database and fill it with synthetic users")
+    seed_parser.add_argument("--users", type=int, default=10000)
+    seed_parser.add_argument("--sessions", type=float, default=1.0, help="share of users logged in on a Telegram chat")
+    seed_parser.add_argument("--preferences", type=int, default=3, help="subjects per user")
+    seed_parser.add_argument("--mode", choices=main.DELIVERY_MODES, help="delivery mode of every user, the default mode when not given")
+    seed_parser.add_argument("--seed", type=int, default=1)
+    seed_parser.set_defaults(func=seed)
+
+    run_parser = commands.add_parser("run", help="run news cycles and commands against the stubs")
+    run_parser.add_argument("--cycles", type=int, default=3)
+    run_parser.add_argument("--new-articles", type=int, default=6, help="new articles per source and cycle on the synthetic pages")
+    run_parser.add_argument("--commands", type=int, default=2000, help="commands sent during each cycle")
+    run_parser.add_argument("--concurrency", type=int, default=50)
+    run_parser.add_argument("--lead-story", action=argparse.BooleanOptionalAction, default=True,
+                            help="keep one lead story on top of the synthetic pages, with the new ones below it")
+    run_parser.add_argument("--flood-every", type=int, default=0, help="answer every n-th message with a flood-limit error")
+    run_parser.add_argument("--bbc", help="saved BBC front page instead of the synthetic one")
+    run_parser.add_argument("--guardian", help="saved Guardian front page instead of the synthetic one")
+    run_parser.add_argument("--seed", type=int, default=1)
+    run_parser.set_defaults(func=run)
+
+    webhook_parser = commands.add_parser("webhook", help="post synthetic updates to a bot running in webhook mode")
+    webhook_parser.add_argument("--url", default="http://127.0.0.1:8443/telegram", help="address of the bot's webhook")
+    webhook_parser.add_argument("--secret", required=True, help="WEBHOOK_SECRET of the bot")
+    webhook_parser.add_argument("--updates", type=int, default=10000)
+    webhook_parser.add_argument("--rate", type=float, default=500, help="updates posted per second")
+    webhook_parser.add_argument("--concurrency", type=int, default=100, help="requests in flight at most")
+    webhook_parser.add_argument("--users", type=int, default=10000, help="chats the updates come from")
+    webhook_parser.add_argument("--bad-secret", type=int, default=10, help="requests sent with a wrong secret first")
+    webhook_parser.add_argument("--wait", type=float, default=120, help="seconds to wait for the bot to start")
+    webhook_parser.add_argument("--timeout", type=float, default=60, help="seconds to wait for the replies after posting")
+    webhook_parser.add_argument("--seed", type=int, default=1)
+    webhook_parser.set_defaults(func=webhook)
+
+    ledger_parser = commands.add_parser("ledger", help="throughput of the delivery ledger for one news cycle (no messages are sent)")
+    ledger_parser.add_argument("--articles", type=int, default=12, help="new articles in the cycle")
+    ledger_parser.add_argument("--recipients", type=int, default=100000, help="sessions every article goes to")
+    ledger_parser.add_argument("--mode", choices=("digest", "instant"), default="digest", help="one digest per session or one message per article")
+    ledger_parser.add_argument("--chunk", type=int, default=main.FAN_OUT_CHUNK, help="sessions per fan-out transaction (FAN_OUT_CHUNK)")
+    ledger_parser.set_defaults(func=ledger)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main_cli()
@@ -4,8 +4,8 @@
 import os
 from dotenv import load_dotenv #Library to import variables from .env file
 
-from bs4 import BeautifulSoup  # Library for web scraping
-import requests  # To send HTTP requests
+from bs4 import BeautifulSoup, SoupStrainer  # Library for web scraping
+import httpx  # To send HTTP requests
 
 from telegram import Bot, Update  # Telegram bot API imports
 from telegram.ext import ContextTypes, Application, CommandHandler  # Telegram bot framework
@@ -13,14 +13,37 @@ from telegram.ext import ContextTypes, Application, CommandHandler  # Telegram b
 import asyncio  # To run asynchronous functions
 import mysql.connector  # MySQL database connection
 from telegram import Update, ForceReply
-from telegram.ext import ApplicationBuilder, CommandHandler, MessageHandler, filters, ContextTypes, ConversationHandler
+from telegram.ext import ApplicationBuilder, BaseUpdateProcessor, CommandHandler, MessageHandler, filters, ContextTypes, ConversationHandler
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter
 import bcrypt # Password hashing
+import numpy as np # Subscription matrix for matching articles to users
+
+import bisect
+import functools
+import gc
+import hashlib
+import importlib.util
+import math
+import multiprocessing
+import queue
+import random
+import re
+import secrets
+import signal
+import sys
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
 
 
 load_dotenv()
 # Initializing the Telegram bot with a token
 BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
-bot = Bot(token=BOT_TOKEN)
+TELEGRAM_API_BASE_URL = os.getenv("TELEGRAM_API_BASE_URL", "https://api.telegram.org/bot") # The load test points this at its stub server
+bot = Bot(token=BOT_TOKEN, base_url=TELEGRAM_API_BASE_URL)
 
 
 # Function to establish a connection to the MySQL database
@@ -29,28 +52,525 @@ def create_connection():
         host=os.getenv("DB_HOST"),
         user=os.getenv("DB_USER"),
         password=os.getenv("DB_PASSWORD"),
-        database=os.getenv("DB_NAME")
+        database=os.getenv("DB_NAME"),
+        autocommit=True # Pooled connections must not keep a stale snapshot open between queries
     )
     return connection
 
 
+#                                               METRICS
+
+# Histogram of observed durations (in seconds) with cumulative buckets
+class Histogram:
+    def __init__(self, buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1) # The last slot counts values above the biggest bucket
+        self.count = 0
+        self.sum = 0.0
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        with self.lock:
+            self.counts[bisect.bisect_left(self.buckets, value)] += 1
+            self.count += 1
+            self.sum += value
+
+    # Returns an upper bound of the requested percentile (0-100) taken from the buckets
+    def percentile(self, percent):
+        with self.lock:
+            if self.count == 0:
+                return 0.0
+            rank = self.count * percent / 100
+            seen = 0
+            for bucket, count in zip(self.buckets, self.counts):
+                seen += count
+                if seen >= rank:
+                    return bucket
+            return float("inf")
+
+    # Cumulative (upper bound, count) pairs, ending with +Inf
+    def cumulative(self):
+        with self.lock:
+            counts = list(self.counts)
+        total = 0
+        for bound, count in zip(self.buckets + (float("inf"),), counts):
+            total += count
+            yield bound, total
+
+# Monotonic count of events
+class Counter:
+    def __init__(self):
+        self.value = 0
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+# Function to escape a label value for the Prometheus text format
+def escape_label(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+# Family of metrics sharing a name, with one child per combination of label values.
+# `collect` makes the values come from a function called on every scrape instead: it returns a number,
+# or a dict of label value tuples -> number for a labelled family
+class MetricFamily:
+    def __init__(self, name, kind, help, labels=(), collect=None):
+        self.name = name
+        self.kind = kind # counter, gauge or histogram
+        self.help = help
+        self.label_names = labels
+        self.collect = collect
+        self.children = {}
+        self.lock = threading.Lock()
+
+    # Returns the child of the given label values, creating it on first use
+    def labels(self, *values):
+        child = self.children.get(values)
+        if child is None:
+            with self.lock:
+                child = self.children.setdefault(values, Histogram() if self.kind == "histogram" else Counter())
+        return child
+
+    # Adds an existing Histogram (or Counter) kept elsewhere as a child
+    def add(self, child, *values):
+        self.children[values] = child
+        return child
+
+    def _label_text(self, values, extra=()):
+        pairs = list(zip(self.label_names, values)) + list(extra)
+        if not pairs:
+            return ""
+        return "{" + ",".join(f'{key}="{escape_label(value)}"' for key, value in pairs) + "}"
+
+    # Lines of the Prometheus text format
+    def expose(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        if self.collect is not None:
+            values = self.collect()
+            for label_values, value in (values.items() if isinstance(values, dict) else [((), values)]):
+                lines.append(f"{self.name}{self._label_text(label_values)} {value}")
+            return lines
+        for label_values, child in list(self.children.items()):
+            if isinstance(child, Histogram):
+                for bound, count in child.cumulative():
+                    le = "+Inf" if bound == float("inf") else bound
+                    lines.append(f"{self.name}_bucket{self._label_text(label_values, [('le', le)])} {count}")
+                lines.append(f"{self.name}_sum{self._label_text(label_values)} {child.sum}")
+                lines.append(f"{self.name}_count{self._label_text(label_values)} {child.count}")
+            else:
+                lines.append(f"{self.name}{self._label_text(label_values)} {child.value}")
+        return lines
+
+METRICS = {} # Metric name -> MetricFamily, in the order they were registered
+
+# Function to register a metric family
+def metric(name, kind, help, labels=(), collect=None):
+    family = METRICS[name] = MetricFamily(name, kind, help, labels, collect)
+    return family
+
+# Function to render every metric in the Prometheus text format
+def render_metrics():
+    lines = []
+    for family in list(METRICS.values()):
+        try:
+            lines.extend(family.expose())
+        except Exception as e: # One broken collector must not hide the others
+            print(f"Error while collecting metric {family.name}: {e}")
+    return "\n".join(lines) + "\n"
+
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9108")) # 0 turns the endpoint off
+
+# Function to answer one request to the metrics endpoint: GET /metrics returns every metric, anything else 404
+async def serve_metrics_request(reader, writer):
+    try:
+        request_line = await asyncio.wait_for(reader.readline(), 5)
+        while await asyncio.wait_for(reader.readline(), 5) not in (b"\r\n", b"\n", b""): # Skipping the headers
+            pass
+        parts = request_line.decode("latin-1").split()
+        if len(parts) >= 2 and parts[0] == "GET" and parts[1].split("?")[0] == "/metrics":
+            status, body = "200 OK", render_metrics().encode()
+        else:
+            status, body = "404 Not Found", b"Not found\n"
+        writer.write(
+            f"HTTP/1.1 {status}\r\n"
+            f"Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+            f"Content-Length: {len(body)}\r\n"
+            f"Connection: close\r\n\r\n".encode() + body
+        )
+        await writer.drain()
+    except (asyncio.TimeoutError, ConnectionError):
+        pass
+    finally:
+        writer.close()
+
+# Function to start the metrics endpoint, returns the server or None when it is turned off
+async def start_metrics_server():
+    if METRICS_PORT == 0:
+        return None
+    server = await asyncio.start_server(serve_metrics_request, METRICS_HOST, METRICS_PORT)
+    print(f"Metrics available at http://{METRICS_HOST}:{METRICS_PORT}/metrics")
+    return server
+
+# Context manager observing the seconds spent in its block
+@contextmanager
+def timed(histogram):
+    started = time.monotonic()
+    try:
+        yield
+    finally:
+        histogram.observe(time.monotonic() - started)
+
+
+#                                               DATABASE CONNECTION POOL
+
+# Bounded pool of MySQL connections shared by every data-access function
+class ConnectionPool:
+    def __init__(self, size, timeout, ping_interval):
+        self.size = size
+        self.timeout = timeout # Seconds a caller may wait for a free connection
+        self.ping_interval = ping_interval # Idle connections older than this are pinged before reuse
+        self.idle = queue.LifoQueue() # (connection, last_used) pairs, the most recently used is reused first
+        self.slots = threading.BoundedSemaphore(size)
+        self.lock = threading.Lock()
+        self.in_use = 0
+        self.wait_time = Histogram()
+
+    # Takes an idle connection (checking it is still alive) or opens a new one
+    def _borrow(self):
+        while True:
+            try:
+                connection, last_used = self.idle.get_nowait()
+            except queue.Empty:
+                return create_connection()
+            if time.monotonic() - last_used < self.ping_interval:
+                return connection
+            try:
+                connection.ping(reconnect=False)
+                return connection
+            except mysql.connector.Error:
+                self._discard(connection)
+
+    def _discard(self, connection):
+        try:
+            connection.close()
+        except mysql.connector.Error:
+            pass
+
+    # Context manager lending a connection that is always returned to the pool
+    @contextmanager
+    def connection(self):
+        started = time.monotonic()
+        if not self.slots.acquire(timeout=self.timeout):
+            self.wait_time.observe(time.monotonic() - started)
+            raise mysql.connector.errors.PoolError(f"No free database connection after {self.timeout} seconds")
+        try:
+            connection = self._borrow()
+        except BaseException:
+            self.slots.release()
+            raise
+        self.wait_time.observe(time.monotonic() - started)
+        with self.lock:
+            self.in_use += 1
+        healthy = True
+        try:
+            yield connection
+        except BaseException:
+            # Not leaving half-finished transactions on a connection which goes back to the pool
+            try:
+                connection.rollback()
+            except mysql.connector.Error:
+                healthy = False
+            raise
+        else:
+            # Explicit transactions (start_transaction) must be finished by the caller
+            if connection.in_transaction:
+                try:
+                    connection.rollback()
+                except mysql.connector.Error:
+                    healthy = False
+        finally:
+            with self.lock:
+                self.in_use -= 1
+            if healthy:
+                self.idle.put((connection, time.monotonic()))
+            else:
+                self._discard(connection)
+            self.slots.release()
+
+    # Snapshot of the pool usage for monitoring
+    def stats(self):
+        return {
+            "size": self.size,
+            "in_use": self.in_use,
+            "idle": self.idle.qsize(),
+            "waits": self.wait_time.count,
+            "wait_seconds_total": self.wait_time.sum,
+            "wait_seconds_p99": self.wait_time.percentile(99),
+        }
+
+    # Closes every idle connection
+    def close(self):
+        while True:
+            try:
+                connection, _ = self.idle.get_nowait()
+            except queue.Empty:
+                return
+            self._discard(connection)
+
+
+db_pool = ConnectionPool(
+    size=int(os.getenv("DB_POOL_SIZE", "10")),
+    timeout=float(os.getenv("DB_POOL_TIMEOUT", "10")),
+    ping_interval=float(os.getenv("DB_POOL_PING_INTERVAL", "30")),
+)
+
+metric("newsbot_db_connections_in_use", "gauge", "Database connections lent out of the pool", collect=lambda: db_pool.in_use)
+metric("newsbot_db_connections_idle", "gauge", "Open database connections waiting in the pool", collect=lambda: db_pool.idle.qsize())
+metric("newsbot_db_pool_wait_seconds", "histogram", "Seconds waited for a database connection").add(db_pool.wait_time)
+
+# Function to borrow a pooled connection: with db_connection() as connection: ...
+def db_connection():
+    return db_pool.connection()
+
+
+
+#                                               IN-MEMORY CACHES
+
+# Bounded mapping which forgets the least recently used key first
+class LRUCache:
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.items = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self.lock:
+            if key not in self.items:
+                return default
+            self.items.move_to_end(key)
+            return self.items[key]
+
+    def put(self, key, value):
+        with self.lock:
+            self.items[key] = value
+            self.items.move_to_end(key)
+            if len(self.items) > self.maxsize:
+                self.items.popitem(last=False)
+
+    def pop(self, key):
+        with self.lock:
+            self.items.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.items.clear()
+
+    def __contains__(self, key):
+        with self.lock:
+            return key in self.items
+
+    def __len__(self):
+        return len(self.items)
+
+
+# LRU cache whose entries also expire `ttl` seconds after they were stored
+class TTLCache(LRUCache):
+    def __init__(self, maxsize, ttl):
+        super().__init__(maxsize)
+        self.ttl = ttl
+
+    def get(self, key, default=None):
+        entry = super().get(key)
+        if entry is None:
+            return default
+        value, expires = entry
+        if time.monotonic() >= expires:
+            self.pop(key)
+            return default
+        return value
+
+    def put(self, key, value):
+        super().put(key, (value, time.monotonic() + self.ttl))
+
+
+# Bloom filter: no false negatives, false positives at about `error_rate` once `capacity` items were added
+class BloomFilter:
+    def __init__(self, capacity, error_rate):
+        self.size = max(8, int(-capacity * math.log(error_rate) / math.log(2) ** 2)) # Bits
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+
+    def _positions(self, item):
+        digest = hashlib.blake2b(item, digest_size=16).digest()
+        first, second = int.from_bytes(digest[:8], "little"), int.from_bytes(digest[8:], "little") | 1
+        return [(first + i * second) % self.size for i in range(self.hashes)]
+
+    def add(self, item):
+        for position in self._positions(item):
+            self.bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, item):
+        return all(self.bits[position >> 3] & (1 << (position & 7)) for position in self._positions(item))
+
+
+# Function to get the compact 8-byte hash under which a link is remembered in seen_links
+def link_hash(link):
+    return hashlib.sha256(link.encode()).digest()[:8]
+
+
+# Hashes of article links known to the database: recent ones exactly (LRU), all of them approximately (Bloom filter)
+class SeenLinks:
+    def __init__(self, capacity, recent):
+        self.bloom = BloomFilter(capacity, 0.001)
+        self.recent = LRUCache(recent)
+        self.lock = threading.Lock()
+
+    def add(self, hashed):
+        with self.lock:
+            self.bloom.add(hashed)
+        self.recent.put(hashed, True)
+
+    # True when the link is known, False when it is certainly new, None when only the database can tell
+    def check(self, hashed):
+        if hashed in self.recent:
+            return True
+        with self.lock:
+            if hashed not in self.bloom:
+                return False
+        return None
+
+
+seen_links = SeenLinks(
+    capacity=int(os.getenv("SEEN_LINKS_CAPACITY", "1000000")),
+    recent=int(os.getenv("SEEN_LINKS_RECENT", "10000")),
+)
+subject_ids = LRUCache(10000) # Subject name -> id
+
+# Telegram id -> (username, real name), or None for a telegram id without a session
+session_cache = TTLCache(
+    maxsize=int(os.getenv("SESSION_CACHE_SIZE", "100000")),
+    ttl=float(os.getenv("SESSION_CACHE_TTL", "600")),
+)
+NOT_CACHED = object()
+
+# Function to load the hashes of seen article links into the seen links cache
+def warm_seen_links():
+    for hashed in get_all_link_hashes():
+        seen_links.add(hashed)
+    print(f"Seen links cache loaded: {len(seen_links.recent)} recent links")
+
+
+
+#                                               SUBJECT CATALOGUE
+
+# Other names users type for subjects, keyed by their normalized form
+SUBJECT_ALIASES = {
+    "britain": "UK",
+    "united kingdom": "UK",
+    "great britain": "UK",
+    "usa": "US and Canada",
+    "us": "US and Canada",
+    "america": "US and Canada",
+    "mideast": "Middle East",
+    "tech": "Technology",
+    "sports": "Sport",
+}
+
+# Function to normalize a subject for lookups: case, spacing, quotes and "&" don't matter
+def normalize_subject(text):
+    text = text.strip().strip('"\'').casefold().replace("&", " and ")
+    return " ".join(text.split())
+
+
+# Versioned in-memory list of subjects; reloaded only after a new subject was stored
+class SubjectCatalogue:
+    def __init__(self):
+        self.version = 0
+        self.names = []
+        self.name_set = set()
+        self.by_key = {} # Normalized name or alias -> subject name
+        self.stale = True
+        self.loaded_at = 0.0
+        self.lock = None # asyncio.Lock, created in the running event loop
+
+    def load(self, names):
+        by_key = {}
+        for alias, name in SUBJECT_ALIASES.items():
+            canonical = next((candidate for candidate in names if normalize_subject(candidate) == normalize_subject(name)), None)
+            if canonical is not None:
+                by_key[alias] = canonical
+        for name in names:
+            by_key[normalize_subject(name)] = name # Real subjects win over aliases
+        self.names = names
+        self.name_set = set(names)
+        self.by_key = by_key
+        self.version += 1
+        self.stale = False
+        self.loaded_at = time.monotonic()
+
+    # Called whenever a subject row was created
+    def invalidate(self):
+        self.stale = True
+
+    # Subjects created by an ingest worker in another process don't invalidate this copy, so it also expires
+    def expired(self):
+        return self.stale or time.monotonic() - self.loaded_at > SUBJECT_CATALOGUE_TTL
+
+    # Returns the stored subject name the text refers to, None when there is none
+    def resolve(self, text):
+        if text in self.name_set:
+            return text
+        return self.by_key.get(normalize_subject(text))
+
+
+SUBJECT_CATALOGUE_TTL = float(os.getenv("SUBJECT_CATALOGUE_TTL", "300"))
+subject_catalogue = SubjectCatalogue()
+metric("newsbot_subject_catalogue_version", "gauge", "Loads of the subject catalogue, it goes up whenever the subjects are reloaded",
+       collect=lambda: subject_catalogue.version)
+
 
 #                                               CREATING DATABASE
 
-#Initializes normalized database schema with foreign key relationships
-def create_tables():
-    connection = create_connection()
-    cursor = connection.cursor()
-    try:
+# Migration steps for the DDL which MySQL can't make idempotent itself (it has no ADD COLUMN/INDEX IF NOT EXISTS).
+# Each checks information_schema first, so a migration which failed part-way can simply run again
+def add_column(table, column, definition):
+    def step(cursor):
+        cursor.execute('SELECT COUNT(*) FROM information_schema.COLUMNS WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s AND COLUMN_NAME = %s',
+                       (table, column))
+        if cursor.fetchone()[0] == 0:
+            cursor.execute(f'ALTER TABLE {table} ADD COLUMN {column} {definition}')
+    return step
+
+def add_index(table, name, columns, unique=False):
+    def step(cursor):
+        cursor.execute('SELECT COUNT(*) FROM information_schema.STATISTICS WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s AND INDEX_NAME = %s',
+                       (table, name))
+        if cursor.fetchone()[0] == 0:
+            cursor.execute(f'ALTER TABLE {table} ADD {"UNIQUE " if unique else ""}INDEX {name} ({columns})')
+    return step
+
+def if_table_exists(table, statement):
+    def step(cursor):
+        cursor.execute('SELECT COUNT(*) FROM information_schema.TABLES WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s', (table,))
+        if cursor.fetchone()[0] > 0:
+            cursor.execute(statement)
+    return step
+
+# Versioned schema migrations: (version, description, steps), applied in order and each only once.
+# MySQL commits every DDL statement on its own, so every step is idempotent: plain SQL which can run twice or a guarded step above
+MIGRATIONS = [
+    (1, "Initial schema", [
         # Subjects table (1st normal form)
-        cursor.execute('''
+        '''
             CREATE TABLE IF NOT EXISTS subjects (
                 id INT AUTO_INCREMENT PRIMARY KEY,
                 name VARCHAR(255) UNIQUE NOT NULL
             )
-        ''')
+        ''',
         # Articles table (relates to subjects)
-        cursor.execute('''
+        '''
             CREATE TABLE IF NOT EXISTS articles (
                 id INT AUTO_INCREMENT PRIMARY KEY,
                 title VARCHAR(255) NOT NULL,
@@ -59,409 +579,1848 @@ def create_tables():
                 subject_id INT,
                 FOREIGN KEY (subject_id) REFERENCES subjects(id)
             )
-        ''')
+        ''',
         # Users table (secure authentication)
-        cursor.execute('''
+        '''
             CREATE TABLE IF NOT EXISTS users (
                 username VARCHAR(255) PRIMARY KEY,
                 realname VARCHAR(255) NOT NULL,
                 password_hash BLOB NOT NULL
             )
-        ''')
-
+        ''',
         # Session management table
-        cursor.execute('''
-                    CREATE TABLE IF NOT EXISTS username_telegramID (
-                        telegram_id BIGINT PRIMARY KEY,
-                        username VARCHAR(255),
-                        FOREIGN KEY (username) REFERENCES users(username)
-                    )
-                ''')
+        '''
+            CREATE TABLE IF NOT EXISTS username_telegramID (
+                telegram_id BIGINT PRIMARY KEY,
+                username VARCHAR(255),
+                FOREIGN KEY (username) REFERENCES users(username)
+            )
+        ''',
         # User preferences junction table (many-to-many)
-        cursor.execute('''
-                            CREATE TABLE IF NOT EXISTS user_preferences (
-                                id INT AUTO_INCREMENT PRIMARY KEY,
-                                username VARCHAR(255),
-                                subject_id INT,
-                                FOREIGN KEY (username) REFERENCES users(username),
-                                FOREIGN KEY (subject_id) REFERENCES subjects(id)
-                            )
-                        ''')
-
-    except():
-        print("Error with creating tables")
-    connection.commit()
-    cursor.close()
-    connection.close()
+        '''
+            CREATE TABLE IF NOT EXISTS user_preferences (
+                id INT AUTO_INCREMENT PRIMARY KEY,
+                username VARCHAR(255),
+                subject_id INT,
+                FOREIGN KEY (username) REFERENCES users(username),
+                FOREIGN KEY (subject_id) REFERENCES subjects(id)
+            )
+        ''',
+        # Newest article link seen on each news source
+        '''
+            CREATE TABLE IF NOT EXISTS news_sources (
+                name VARCHAR(64) PRIMARY KEY,
+                watermark VARCHAR(255),
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP
+            )
+        ''',
+        # Dead letters of messages which could not be delivered
+        '''
+            CREATE TABLE IF NOT EXISTS failed_deliveries (
+                id INT AUTO_INCREMENT PRIMARY KEY,
+                telegram_id BIGINT NOT NULL,
+                message TEXT NOT NULL,
+                error VARCHAR(255),
+                failed_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        ''',
+    ]),
+    (2, "Indexes for sessions, preferences and subscriber fan-out", [
+        # Removing duplicate and dangling preferences before they become impossible
+        '''
+            DELETE duplicate FROM user_preferences AS duplicate
+            INNER JOIN user_preferences AS kept
+                ON kept.username = duplicate.username AND kept.subject_id = duplicate.subject_id AND kept.id < duplicate.id
+        ''',
+        'DELETE FROM user_preferences WHERE username IS NULL OR subject_id IS NULL',
+        # One row per (user, subject), also serving the lookups of a user's preferences
+        add_index('user_preferences', 'user_subject', 'username, subject_id', unique=True),
+        # Subject -> subscribers fan-out
+        add_index('user_preferences', 'subject_user', 'subject_id, username'),
+        # User -> sessions for the fan-out and the subscription index
+        add_index('username_telegramID', 'username_session', 'username, telegram_id'),
+    ]),
+    (3, "Article ingestion time and seen link hashes for retention", [
+        add_column('articles', 'ingested_at', 'TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP'),
+        add_index('articles', 'ingested_at', 'ingested_at'),
+        # First 8 bytes of the SHA-256 of each link (see link_hash), kept after the article was pruned
+        '''
+            CREATE TABLE IF NOT EXISTS seen_links (
+                link_hash BINARY(8) PRIMARY KEY,
+                seen_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+                INDEX seen_at (seen_at)
+            )
+        ''',
+        'INSERT IGNORE INTO seen_links (link_hash) SELECT UNHEX(LEFT(SHA2(link, 256), 16)) FROM articles WHERE link IS NOT NULL',
+    ]),
+    (4, "Delivery modes and daily digests", [
+        # NULL means DEFAULT_DELIVERY_MODE
+        add_column('users', 'delivery_mode', 'VARCHAR(16) NULL'),
+        add_column('articles', 'source', 'VARCHAR(64) NULL'),
+        # Articles waiting for the daily digest of a session
+        '''
+            CREATE TABLE IF NOT EXISTS daily_digest_items (
+                telegram_id BIGINT NOT NULL,
+                article_id INT NOT NULL,
+                PRIMARY KEY (telegram_id, article_id),
+                INDEX article_id (article_id)
+            )
+        ''',
+    ]),
+    (5, "Durable delivery job queue", [
+        # Messages waiting to be sent; a claimed job is hidden until available_at, so it comes back when its sender dies
+        '''
+            CREATE TABLE IF NOT EXISTS delivery_jobs (
+                id BIGINT AUTO_INCREMENT PRIMARY KEY,
+                shard SMALLINT NOT NULL,
+                telegram_id BIGINT NOT NULL,
+                message TEXT NOT NULL,
+                parse_mode VARCHAR(16) NULL,
+                attempts INT NOT NULL DEFAULT 0,
+                available_at TIMESTAMP(3) NOT NULL DEFAULT CURRENT_TIMESTAMP(3),
+                INDEX shard_available (shard, available_at)
+            )
+        ''',
+    ]),
+    (6, "Delivery ledger", [
+        # One row per article and session: waiting for the daily digest, queued as a job, sent or failed
+        '''
+            CREATE TABLE IF NOT EXISTS deliveries (
+                article_id INT NOT NULL,
+                telegram_id BIGINT NOT NULL,
+                job_id BIGINT NULL,
+                status TINYINT NOT NULL,
+                created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+                PRIMARY KEY (article_id, telegram_id),
+                INDEX job_id (job_id),
+                INDEX status_telegram (status, telegram_id),
+                INDEX created_at (created_at)
+            )
+        ''',
+        if_table_exists('daily_digest_items',
+                        'INSERT IGNORE INTO deliveries (article_id, telegram_id, status) SELECT article_id, telegram_id, 0 FROM daily_digest_items'),
+        'DROP TABLE IF EXISTS daily_digest_items',
+        # Articles whose jobs and ledger rows were not written yet; the stored ones already went out
+        add_column('articles', 'fanned_out', 'BOOLEAN NOT NULL DEFAULT FALSE'),
+        add_index('articles', 'fanned_out', 'fanned_out'),
+        'UPDATE articles SET fanned_out = TRUE',
+    ]),
+    (7, "Drop the source watermarks", [
+        # New articles are told apart by the seen links alone since the whole list of a page is read
+        'DROP TABLE IF EXISTS news_sources',
+    ]),
+]
+
+# Function to get the version of the database schema, 0 for an empty database
+def get_schema_version(cursor):
+    try:
+        cursor.execute('SELECT COALESCE(MAX(version), 0) FROM schema_version')
+    except mysql.connector.ProgrammingError:
+        return 0 # No schema_version table yet
+    return cursor.fetchone()[0]
+
+#Brings the normalized database schema up to date; does no DDL when it is already current
+def migrate_database():
+    latest = MIGRATIONS[-1][0]
+    with db_connection() as connection:
+        cursor = connection.cursor()
+        if get_schema_version(cursor) >= latest:
+            cursor.close()
+            return
+        # Only one process at a time may migrate; 0 means another one held the lock for the whole minute, NULL an error
+        cursor.execute('SELECT GET_LOCK(%s, 60)', ('news_bot_migrations',))
+        locked = cursor.fetchone()[0]
+        if locked != 1:
+            cursor.close()
+            raise RuntimeError("another process has been migrating the database for over a minute, try again once it is done")
+        try:
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS schema_version (
+                    version INT PRIMARY KEY,
+                    description VARCHAR(255) NOT NULL,
+                    applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )
+            ''')
+            current = get_schema_version(cursor)
+            for version, description, steps in MIGRATIONS:
+                if version <= current:
+                    continue
+                print(f"Applying database migration {version}: {description}")
+                for step in steps:
+                    if callable(step):
+                        step(cursor)
+                    else:
+                        cursor.execute(step)
+                cursor.execute('INSERT INTO schema_version (version, description) VALUES (%s, %s)', (version, description))
+        finally:
+            cursor.execute('SELECT RELEASE_LOCK(%s)', ('news_bot_migrations',))
+            cursor.fetchone()
+            cursor.close()
+
+
+# Hot queries with the index each of their tables must be able to use: (name, query, parameters, {table: index})
+HOT_QUERIES = [
+    ("session lookup",
+     'SELECT users.username, users.realname FROM username_telegramID INNER JOIN users ON users.username = username_telegramID.username WHERE username_telegramID.telegram_id = %s',
+     (1,), {"username_telegramID": "PRIMARY", "users": "PRIMARY"}),
+    ("user preferences",
+     'SELECT name FROM subjects INNER JOIN user_preferences ON subjects.id = user_preferences.subject_id WHERE username = %s',
+     ("user",), {"user_preferences": "user_subject", "subjects": "PRIMARY"}),
+    ("subscriber fan-out",
+     '''SELECT DISTINCT subjects.name, username_telegramID.telegram_id, users.realname, users.delivery_mode FROM subjects
+        INNER JOIN user_preferences ON user_preferences.subject_id = subjects.id
+        INNER JOIN username_telegramID ON username_telegramID.username = user_preferences.username
+        INNER JOIN users ON users.username = user_preferences.username
+        WHERE subjects.name IN (%s, %s)''',
+     ("UK", "World"), {"subjects": "name", "user_preferences": "subject_user", "username_telegramID": "username_session", "users": "PRIMARY"}),
+    ("article dedupe",
+     'SELECT link_hash FROM seen_links WHERE link_hash IN (%s, %s)',
+     (b"aaaaaaaa", b"bbbbbbbb"), {"seen_links": "PRIMARY"}),
+    ("delivery job claim",
+     'SELECT id, telegram_id, message, parse_mode FROM delivery_jobs WHERE shard IN (%s, %s) AND available_at <= NOW(3) LIMIT 100 FOR UPDATE SKIP LOCKED',
+     (0, 1), {"delivery_jobs": "shard_available"}),
+    ("delivery ledger of finished jobs",
+     'UPDATE deliveries SET status = 2 WHERE job_id IN (%s, %s)',
+     (1, 2), {"deliveries": "job_id"}),
+    ("daily digest deliveries",
+     'SELECT article_id, telegram_id FROM deliveries WHERE status = 0 AND telegram_id IN (%s, %s)',
+     (1, 2), {"deliveries": "status_telegram"}),
+]
+
+# Function to EXPLAIN the hot queries; returns a list of problems, empty when every table can use its index
+def check_query_plans():
+    problems = []
+    with db_connection() as connection:
+        cursor = connection.cursor(dictionary=True)
+        for name, query, parameters, expected in HOT_QUERIES:
+            cursor.execute('EXPLAIN ' + query, parameters)
+            plan = {row["table"]: row for row in cursor.fetchall()}
+            for table, index in expected.items():
+                row = plan.get(table)
+                if row is None:
+                    continue # Optimised away, e.g. an impossible WHERE on an empty table
+                possible = (row["possible_keys"] or "").split(",")
+                if row["key"] != index and index not in possible:
+                    problems.append(f"{name}: {table} can't use index {index} (type {row['type']}, key {row['key']})")
+        cursor.close()
+    return problems
 
 
 
 #                                               CORE DATA MODEL
 
-#Inserting new subject to the database
-def insert_subject(subject_name):
-    connection = create_connection()
-    cursor = connection.cursor()
-    cursor.execute('SELECT id FROM subjects WHERE name = %s', (subject_name,))
-    result = cursor.fetchone()
-    if result is None:
-        cursor.execute('INSERT INTO subjects (name) VALUES (%s)', (subject_name,))
-        connection.commit()
-        subject_id = cursor.lastrowid
-    else:
-        subject_id = result[0]
-    cursor.close()
-    connection.close()
-    return subject_id
-
-# Function to check if an article already exists in the database
-def article_exists(link):
-    connection = create_connection()
-    cursor = connection.cursor()
-    cursor.execute('SELECT id FROM articles WHERE link = %s', (link,))
-    result = cursor.fetchone()
-    cursor.close()
-    connection.close()
-    return result is not None
-
 # Function to check if a user already exists in the subscribers list
 def user_exists(username):
-    connection = create_connection()
-    cursor = connection.cursor()
-    cursor.execute('SELECT id FROM users WHERE username = %s', (username,))
-    result = cursor.fetchone()
-    cursor.close()
-    connection.close()
+    with db_connection() as connection:
+        cursor = connection.cursor()
+        cursor.execute('SELECT 1 FROM users WHERE username = %s', (username,))
+        result = cursor.fetchone()
+        cursor.close()
     return result is not None
 
 # Function to add a new user to the subscribers list
 def insert_user(username,realname,password_hash):
-    connection = create_connection()
-    cursor = connection.cursor()
-    cursor.execute('INSERT INTO users (username, realname, password_hash) VALUES (%s, %s, %s)', (username, realname, password_hash))
-    connection.commit()
-    cursor.close()
-    connection.close()
+    with db_connection() as connection:
+        cursor = connection.cursor()
+        cursor.execute('INSERT INTO users (username, realname, password_hash) VALUES (%s, %s, %s)', (username, realname, password_hash))
+        cursor.close()
 
 # Function to add a new user session to the database
 def insert_username_telegramid(telegram_id,username):
-    connection = create_connection()
-    cursor = connection.cursor()
-    cursor.execute('INSERT INTO username_telegramID (username, telegram_id) VALUES (%s, %s)',
-                   (username, telegram_id))
-    connection.commit()
-    cursor.close()
-    connection.close()
+    with db_connection() as connection:
+        cursor = connection.cursor()
+        cursor.execute('INSERT INTO username_telegramID (username, telegram_id) VALUES (%s, %s)',
+                       (username, telegram_id))
+        cursor.close()
 
 
 # Function to remove a user session from the database
 def remove_user_session(telegram_id):
-    connection = create_connection()
-    cursor = connection.cursor()
-    cursor.execute('DELETE FROM username_telegramID WHERE telegram_id = %s', (telegram_id,))
-    connection.commit()
-    cursor.close()
-    connection.close()
-
-
-# Function to get all usernames from the subscribers list
-def get_all_usernames():
-    connection = create_connection()
-    cursor = connection.cursor()
-    cursor.execute('SELECT username FROM users')
-    usernames = [row[0] for row in cursor.fetchall()]
-    cursor.close()
-    connection.close()
-    return usernames
-
-# Function to get all telegram ids of current sessions
-def get_all_telegram_ids():
-    connection = create_connection()
-    cursor = connection.cursor()
-    cursor.execute('SELECT telegram_id FROM username_telegramID')
-    telegramids = [row[0] for row in cursor.fetchall()]
-    print(telegramids)
-    cursor.close()
-    connection.close()
-    return telegramids
+    with db_connection() as connection:
+        cursor = connection.cursor()
+        cursor.execute('DELETE FROM username_telegramID WHERE telegram_id = %s', (telegram_id,))
+        cursor.close()
 
 
 # Function to get user's real name
 def get_user_realname(username):
-    connection = create_connection()
-    cursor = connection.cursor()
-    cursor.execute('SELECT realname FROM users WHERE username = %s', (username,))
-    realname = cursor.fetchone()[0]
-    cursor.close()
-    connection.close()
+    with db_connection() as connection:
+        cursor = connection.cursor()
+        cursor.execute('SELECT realname FROM users WHERE username = %s', (username,))
+        realname = cursor.fetchone()[0]
+        cursor.close()
     return realname
 
 # Function to get user's password
 def get_user_password(username):
-    connection = create_connection()
-    cursor = connection.cursor()
-    cursor.execute('SELECT password_hash FROM users WHERE username = %s', (username,))
-    password_hash = cursor.fetchone()[0]
-    cursor.close()
-    connection.close()
+    with db_connection() as connection:
+        cursor = connection.cursor()
+        cursor.execute('SELECT password_hash FROM users WHERE username = %s', (username,))
+        password_hash = cursor.fetchone()[0]
+        cursor.close()
     return password_hash
 
 # Function to get user's preferences
 def get_user_preferences(username):
-    connection = create_connection()
-    cursor = connection.cursor()
-    cursor.execute('SELECT name FROM subjects INNER JOIN user_preferences ON subjects.id = user_preferences.subject_id WHERE username = %s', (username,))
-    preferred_subjects = [row[0] for row in cursor.fetchall()]
-    cursor.close()
-    connection.close()
+    with db_connection() as connection:
+        cursor = connection.cursor()
+        cursor.execute('SELECT name FROM subjects INNER JOIN user_preferences ON subjects.id = user_preferences.subject_id WHERE username = %s', (username,))
+        preferred_subjects = [row[0] for row in cursor.fetchall()]
+        cursor.close()
     return preferred_subjects
 
 # Function to add a preference to user's list of preferences
 def add_user_preference(username,subject_name):
-    connection = create_connection()
-    cursor = connection.cursor()
-    cursor.execute('INSERT INTO user_preferences (username, subject_id) VALUES (%s, (SELECT id FROM subjects WHERE name = %s))', (username, subject_name))
-    connection.commit()
-    cursor.close()
-    connection.close()
+    with db_connection() as connection:
+        cursor = connection.cursor()
+        cursor.execute('INSERT INTO user_preferences (username, subject_id) VALUES (%s, (SELECT id FROM subjects WHERE name = %s))', (username, subject_name))
+        cursor.close()
 
 # Function to get all available subjects
 def get_all_subjects():
-    connection = create_connection()
-    cursor = connection.cursor()
-    cursor.execute('SELECT name FROM subjects WHERE name NOT IN ("Unknown", "n/a")')
-    subjects = [row[0] for row in cursor.fetchall()]
-    cursor.close()
-    connection.close()
+    with db_connection() as connection:
+        cursor = connection.cursor()
+        cursor.execute('SELECT name FROM subjects WHERE name NOT IN ("Unknown", "n/a")')
+        subjects = [row[0] for row in cursor.fetchall()]
+        cursor.close()
     return subjects
 
-# Function to check if user has a particular preference
-def check_user_preference(username,subject_name):
-    user_preferences = get_user_preferences(username)
-    if subject_name in user_preferences:
-        return True
-    else:
-        return False
-
 # Function to remove a preference from user's list of preferences
 def remove_user_preference(username,subject_name):
-    connection = create_connection()
-    cursor = connection.cursor()
-    cursor.execute('DELETE FROM user_preferences WHERE username = %s AND subject_id = (SELECT id FROM subjects WHERE name = %s)', (username, subject_name))
-    connection.commit()
+    with db_connection() as connection:
+        cursor = connection.cursor()
+        cursor.execute('DELETE FROM user_preferences WHERE username = %s AND subject_id = (SELECT id FROM subjects WHERE name = %s)', (username, subject_name))
+        cursor.close()
 
 # Function to empty user's list of preferences
 def clear_user_preferences(username):
-    connection = create_connection()
-    cursor = connection.cursor()
-    cursor.execute('DELETE FROM user_preferences WHERE username = %s', (username,))
-    connection.commit()
-    cursor.close()
-    connection.close()
-
-# Function to get user's username from telegram id
-def get_username(telegram_id):
-    connection = create_connection()
-    cursor = connection.cursor()
-    cursor.execute('SELECT username FROM username_telegramID WHERE telegram_id = %s', (telegram_id,))
-    username = cursor.fetchone()[0]
-    return username
-
-# Function to add a new article to the articles list
-def insert_article(article):
-    if article_exists(article.link):
-        print(f"Article already exists in the database: {article.title}")
-        return False
-    connection = create_connection()
-    cursor = connection.cursor()
-    subject_id = insert_subject(article.subject)
-    try:
+    with db_connection() as connection:
+        cursor = connection.cursor()
+        cursor.execute('DELETE FROM user_preferences WHERE username = %s', (username,))
+        cursor.close()
+
+# Function to get the logged in subscribers of each subject as (telegram id, real name) pairs
+def get_subject_subscribers(subject_names):
+    subscribers = {subject_name: [] for subject_name in subject_names}
+    if not subject_names:
+        return subscribers
+    placeholders = ', '.join(['%s'] * len(subject_names))
+    with db_connection() as connection:
+        cursor = connection.cursor()
+        cursor.execute(f'''
+            SELECT DISTINCT subjects.name, username_telegramID.telegram_id, users.realname, users.delivery_mode
+            FROM subjects
+            INNER JOIN user_preferences ON user_preferences.subject_id = subjects.id
+            INNER JOIN username_telegramID ON username_telegramID.username = user_preferences.username
+            INNER JOIN users ON users.username = user_preferences.username
+            WHERE subjects.name IN ({placeholders})
+        ''', tuple(subject_names))
+        for subject_name, telegram_id, realname, mode in cursor.fetchall():
+            subscribers[subject_name].append((telegram_id, realname, mode or DEFAULT_DELIVERY_MODE))
+        cursor.close()
+    return subscribers
+
+# Function to get every session with its username, real name and delivery mode
+def get_all_sessions():
+    with db_connection() as connection:
+        cursor = connection.cursor()
         cursor.execute('''
-            INSERT INTO articles (title, publicationTime, link, subject_id)
-            VALUES (%s, %s, %s, %s)
-        ''', (article.title, article.publicationTime, article.link, subject_id))
-        connection.commit()
-        print(f"Inserted article: {article.title}")
-        return True
-    except mysql.connector.Error as err:
-        print(f"Error: {err}")
-    cursor.close()
-    connection.close()
-
-# Function to check a session is going for telegram id
-def check_session(telegram_id):
-    telegram_ids = get_all_telegram_ids()
-    if telegram_id in telegram_ids:
-        return True
+            SELECT username_telegramID.telegram_id, users.username, users.realname, users.delivery_mode
+            FROM username_telegramID
+            INNER JOIN users ON users.username = username_telegramID.username
+        ''')
+        sessions = [(telegram_id, username, realname, mode or DEFAULT_DELIVERY_MODE) for telegram_id, username, realname, mode in cursor.fetchall()]
+        cursor.close()
+    return sessions
+
+# Function to get every (username, subject name) preference pair
+def get_all_user_preferences():
+    with db_connection() as connection:
+        cursor = connection.cursor()
+        cursor.execute('SELECT user_preferences.username, subjects.name FROM user_preferences INNER JOIN subjects ON subjects.id = user_preferences.subject_id')
+        user_preferences = cursor.fetchall()
+        cursor.close()
+    return user_preferences
+
+# Function to get the hashes of all seen article links, oldest first
+def get_all_link_hashes():
+    with db_connection() as connection:
+        cursor = connection.cursor()
+        cursor.execute('SELECT link_hash FROM seen_links ORDER BY seen_at')
+        hashes = [bytes(row[0]) for row in cursor.fetchall()]
+        cursor.close()
+    return hashes
+
+# Raised when a concurrent writer stored some of the same links while a batch was being stored
+class LinkRace(Exception):
+    pass
+
+# Function to store the candidate articles ({link hash: article}) in one transaction; returns
+# (new articles, {subject name: id} of the subjects it read, whether it created subjects).
+# Links the cache can't vouch for (all of them with look_up_all) are looked up with a plain consistent read, the rest are
+# inserted into seen_links with INSERT IGNORE in key order: no gap locks are taken and a row counted as inserted is certainly ours
+def store_articles(candidates, look_up_all=False):
+    with db_connection() as connection:
+        cursor = connection.cursor()
+        connection.start_transaction()
+        try:
+            subjects = list({article.subject for article in candidates.values()})
+            found_subjects = {subject_name: subject_ids.get(subject_name) for subject_name in subjects}
+            missing = [subject_name for subject_name, subject_id in found_subjects.items() if subject_id is None]
+            created_subjects = False
+            if missing:
+                placeholders = ', '.join(['(%s)'] * len(missing))
+                cursor.execute(f'INSERT IGNORE INTO subjects (name) VALUES {placeholders}', tuple(missing))
+                created_subjects = cursor.rowcount > 0
+                cursor.execute(f'SELECT id, name FROM subjects WHERE name IN ({", ".join(["%s"] * len(missing))})', tuple(missing))
+                for subject_id, subject_name in cursor.fetchall():
+                    found_subjects[subject_name] = subject_id
+
+            unsure = [hashed for hashed in candidates if look_up_all or seen_links.check(hashed) is None]
+            if unsure:
+                cursor.execute(f'SELECT link_hash FROM seen_links WHERE link_hash IN ({", ".join(["%s"] * len(unsure))})', tuple(unsure))
+                for (hashed,) in cursor.fetchall():
+                    seen_links.add(bytes(hashed)) # Committed by someone else, so it is safe to remember
+                    del candidates[bytes(hashed)]
+
+            new_articles = []
+            if candidates:
+                hashes = sorted(candidates)
+                cursor.execute(f'INSERT IGNORE INTO seen_links (link_hash) VALUES {", ".join(["(%s)"] * len(hashes))}', tuple(hashes))
+                if cursor.rowcount != len(hashes):
+                    raise LinkRace()
+                new_articles = list(candidates.values())
+                placeholders = ', '.join(['(%s, %s, %s, %s, %s)'] * len(new_articles))
+                values = []
+                for article in new_articles:
+                    values += [article.title, article.publicationTime, article.link, found_subjects.get(article.subject), article.source]
+                cursor.execute(f'INSERT INTO articles (title, publicationTime, link, subject_id, source) VALUES {placeholders}', tuple(values))
+                # Reading the ids back through the unique link index
+                by_link = {article.link: article for article in new_articles}
+                cursor.execute(f'SELECT id, link FROM articles WHERE link IN ({", ".join(["%s"] * len(by_link))})', tuple(by_link))
+                for article_id, link in cursor.fetchall():
+                    by_link[link].id = article_id
+            connection.commit()
+        finally:
+            cursor.close()
+    return new_articles, found_subjects, created_subjects
+
+# Function to store a batch of scraped articles in one transaction and return the ones which are new.
+# Dedupe goes through the compact seen_links table, which outlives the articles themselves, and links known
+# to the seen links cache are dropped without a query. The caches only learn about rows once they are committed
+def insert_articles(articles):
+    candidates = {} # Link hash -> article
+    for article in articles:
+        hashed = link_hash(article.link)
+        if hashed not in candidates and not seen_links.check(hashed):
+            candidates[hashed] = article
+    if not candidates:
+        return []
+    for attempt in range(3):
+        try:
+            new_articles, found_subjects, created_subjects = store_articles(dict(candidates), look_up_all=attempt > 0)
+            break
+        except LinkRace:
+            # The rolled back batch is stored again, looking every link up in a fresh snapshot which sees the other writer's
+            print("Another writer stored some of the same links, storing the batch again")
     else:
-        return False
+        raise LinkRace(f"gave up storing {len(candidates)} articles after 3 attempts")
+    for subject_name, subject_id in found_subjects.items():
+        if subject_id is not None:
+            subject_ids.put(subject_name, subject_id)
+    if created_subjects:
+        subject_catalogue.invalidate()
+    for article in new_articles:
+        seen_links.add(link_hash(article.link))
+    print(f"Inserted {len(new_articles)} new articles out of {len(articles)}")
+    return new_articles
+
+# Retention: articles are kept for ARTICLE_RETENTION_DAYS, the hashes of their links for longer so that
+# stories which are still on a front page are not sent again after their article row was pruned
+ARTICLE_RETENTION_DAYS = int(os.getenv("ARTICLE_RETENTION_DAYS", "30"))
+SEEN_LINKS_RETENTION_DAYS = max(ARTICLE_RETENTION_DAYS, int(os.getenv("SEEN_LINKS_RETENTION_DAYS", "365")))
+PRUNE_BATCH_SIZE = 1000
+
+# Function to delete rows older than the retention period in small batches, so no long lock is held
+def prune_table(table, column, days):
+    deleted = 0
+    while True:
+        with db_connection() as connection:
+            cursor = connection.cursor()
+            cursor.execute(f'DELETE FROM {table} WHERE {column} < NOW() - INTERVAL %s DAY ORDER BY {column} LIMIT %s',
+                           (days, PRUNE_BATCH_SIZE))
+            count = cursor.rowcount
+            cursor.close()
+        deleted += count
+        if count < PRUNE_BATCH_SIZE:
+            return deleted
+
+# Function to apply the retention policy
+def prune_old_data():
+    articles = prune_table('articles', 'ingested_at', ARTICLE_RETENTION_DAYS)
+    deliveries = prune_table('deliveries', 'created_at', ARTICLE_RETENTION_DAYS)
+    links = prune_table('seen_links', 'seen_at', SEEN_LINKS_RETENTION_DAYS)
+    print(f"Retention: pruned {articles} articles, {deliveries} deliveries and {links} seen links")
+
+# Function to get how a user wants to receive articles
+def get_delivery_mode(username):
+    with db_connection() as connection:
+        cursor = connection.cursor()
+        cursor.execute('SELECT delivery_mode FROM users WHERE username = %s', (username,))
+        row = cursor.fetchone()
+        cursor.close()
+    return row[0] if row and row[0] else DEFAULT_DELIVERY_MODE
+
+# Function to change how a user wants to receive articles
+def set_delivery_mode(username, mode):
+    with db_connection() as connection:
+        cursor = connection.cursor()
+        cursor.execute('UPDATE users SET delivery_mode = %s WHERE username = %s', (mode, username))
+        cursor.close()
+
+# States of a row in the deliveries ledger
+DELIVERY_WAITING, DELIVERY_QUEUED, DELIVERY_SENT, DELIVERY_FAILED = range(4)
+
+# Messages of one chat always land in the same shard, so one sender handles them in order and within the chat's rate limit
+JOB_SHARDS = int(os.getenv("JOB_SHARDS", "64"))
+LEDGER_BATCH = 1000 # Rows per multi-row INSERT, well below max_allowed_packet
+FAN_OUT_CHUNK = int(os.getenv("FAN_OUT_CHUNK", "2000")) # Sessions per fan-out transaction, keeps the article locks short
+
+# Function to insert (telegram id, message, article ids) jobs in the open transaction of `cursor`;
+# returns their (article id, telegram id, job id, status) ledger rows
+def insert_jobs(cursor, jobs, parse_mode):
+    deliveries = []
+    for start in range(0, len(jobs), 500):
+        batch = jobs[start:start + 500]
+        cursor.execute(f'INSERT INTO delivery_jobs (shard, telegram_id, message, parse_mode) VALUES {", ".join(["(%s, %s, %s, %s)"] * len(batch))}',
+                       tuple(value for telegram_id, message, _ in batch for value in (telegram_id % JOB_SHARDS, telegram_id, message, parse_mode)))
+        # InnoDB gives the rows of one multi-row INSERT consecutive ids starting at lastrowid (auto_increment_increment = 1)
+        for offset, (telegram_id, _, article_ids) in enumerate(batch):
+            deliveries += [(article_id, telegram_id, cursor.lastrowid + offset, DELIVERY_QUEUED) for article_id in article_ids]
+    return deliveries
+
+# Function to write (article id, telegram id, job id, status) rows into the ledger in the open transaction of `cursor`
+def insert_deliveries(cursor, deliveries):
+    for start in range(0, len(deliveries), LEDGER_BATCH):
+        batch = deliveries[start:start + LEDGER_BATCH]
+        cursor.execute(f'''
+            INSERT INTO deliveries (article_id, telegram_id, job_id, status) VALUES {", ".join(["(%s, %s, %s, %s)"] * len(batch))}
+            ON DUPLICATE KEY UPDATE job_id = VALUES(job_id), status = VALUES(status)
+        ''', tuple(value for row in batch for value in row))
+
+# Raised when a concurrent fan-out published ledger rows of the same articles for the same sessions
+class LedgerRace(Exception):
+    pass
+
+# Function to get the (article id, telegram id) pairs of the ledger for the given articles; empty unless an earlier fan-out
+# of them was interrupted after some of its chunks were published
+def get_delivered_pairs(article_ids):
+    if not article_ids:
+        return set()
+    with db_connection() as connection:
+        cursor = connection.cursor()
+        cursor.execute(f'SELECT article_id, telegram_id FROM deliveries WHERE article_id IN ({", ".join(["%s"] * len(article_ids))})', tuple(article_ids))
+        pairs = set(cursor.fetchall())
+        cursor.close()
+    return pairs
+
+# Function to publish the fan-out of stored articles: the jobs, their ledger rows and the (telegram id, article id) pairs waiting
+# for the daily digest, in one transaction per FAN_OUT_CHUNK sessions, then the articles' fanned_out flag with the last chunk.
+# Every chunk locks the articles and checks them first; when any were fanned out already, the chunk is not written and their
+# ids are returned. A chunk whose ledger rows exist already raises LedgerRace, so no article goes out twice to a session
+def publish_fan_out(article_ids, jobs, waiting, parse_mode="MarkdownV2"):
+    if not article_ids:
+        return set()
+    placeholders = ", ".join(["%s"] * len(article_ids))
+    sessions = {} # Telegram id -> (jobs, ids of the articles waiting for the daily digest); all of a session's rows go in one chunk
+    for job in jobs:
+        sessions.setdefault(job[0], ([], []))[0].append(job)
+    for telegram_id, article_id in waiting:
+        sessions.setdefault(telegram_id, ([], []))[1].append(article_id)
+    telegram_ids = sorted(sessions)
+    chunks = [telegram_ids[start:start + FAN_OUT_CHUNK] for start in range(0, len(telegram_ids), FAN_OUT_CHUNK)] or [[]]
+    with db_connection() as connection:
+        cursor = connection.cursor()
+        try:
+            for number, chunk in enumerate(chunks):
+                connection.start_transaction()
+                cursor.execute(f'SELECT id FROM articles WHERE id IN ({placeholders}) AND fanned_out = FALSE FOR UPDATE', tuple(article_ids))
+                published = set(article_ids) - {row[0] for row in cursor.fetchall()}
+                if published:
+                    connection.rollback()
+                    return published
+                chunk_jobs = [job for telegram_id in chunk for job in sessions[telegram_id][0]]
+                chunk_waiting = [(article_id, telegram_id, None, DELIVERY_WAITING) for telegram_id in chunk for article_id in sessions[telegram_id][1]]
+                if chunk:
+                    # The article locks are held, so a fan-out of the same articles can't commit a chunk in between
+                    cursor.execute(f'SELECT article_id, telegram_id FROM deliveries WHERE article_id IN ({placeholders}) AND telegram_id IN ({", ".join(["%s"] * len(chunk))})',
+                                   (*article_ids, *chunk))
+                    existing = set(cursor.fetchall())
+                    if existing and (any((article_id, telegram_id) in existing for telegram_id, _, job_article_ids in chunk_jobs for article_id in job_article_ids)
+                                     or any((article_id, telegram_id) in existing for article_id, telegram_id, _, _ in chunk_waiting)):
+                        raise LedgerRace()
+                insert_deliveries(cursor, insert_jobs(cursor, chunk_jobs, parse_mode) + chunk_waiting)
+                if number == len(chunks) - 1:
+                    cursor.execute(f'UPDATE articles SET fanned_out = TRUE WHERE id IN ({placeholders})', tuple(article_ids))
+                connection.commit()
+        finally:
+            cursor.close()
+    return set()
+
+# Function to get the stored articles whose fan-out was not published, e.g. because the process stopped in between
+def get_unpublished_articles():
+    with db_connection() as connection:
+        cursor = connection.cursor()
+        cursor.execute('''
+            SELECT articles.id, articles.title, subjects.name, articles.publicationTime, articles.link, articles.source
+            FROM articles LEFT JOIN subjects ON subjects.id = articles.subject_id
+            WHERE articles.fanned_out = FALSE
+            ORDER BY articles.id
+        ''')
+        rows = cursor.fetchall()
+        cursor.close()
+    articles = []
+    for article_id, title, subject, publication_time, link, source in rows:
+        article = Article(title, subject or "Unknown", publication_time or "No Time", link, source or "")
+        article.id = article_id
+        articles.append(article)
+    return articles
+
+# Function to get every article waiting for a daily digest, as (telegram id, real name, Article) rows.
+# The waiting rows of logged out sessions are dropped
+def get_daily_digest_items():
+    with db_connection() as connection:
+        cursor = connection.cursor()
+        cursor.execute('''
+            DELETE deliveries FROM deliveries
+            LEFT JOIN username_telegramID ON username_telegramID.telegram_id = deliveries.telegram_id
+            WHERE deliveries.status = %s AND username_telegramID.telegram_id IS NULL
+        ''', (DELIVERY_WAITING,))
+        cursor.execute('''
+            SELECT deliveries.telegram_id, users.realname, articles.id, articles.title, subjects.name,
+                   articles.publicationTime, articles.link, articles.source
+            FROM deliveries
+            INNER JOIN articles ON articles.id = deliveries.article_id
+            LEFT JOIN subjects ON subjects.id = articles.subject_id
+            INNER JOIN username_telegramID ON username_telegramID.telegram_id = deliveries.telegram_id
+            INNER JOIN users ON users.username = username_telegramID.username
+            WHERE deliveries.status = %s
+            ORDER BY deliveries.telegram_id, articles.id
+        ''', (DELIVERY_WAITING,))
+        rows = cursor.fetchall()
+        cursor.close()
+    items = []
+    for telegram_id, realname, article_id, title, subject, publication_time, link, source in rows:
+        article = Article(title, subject or "Unknown", publication_time or "No Time", link, source or "")
+        article.id = article_id
+        items.append((telegram_id, realname, article))
+    return items
+
+# Function to publish daily digest jobs and move their ledger rows from waiting to queued in one transaction.
+# A job goes out only if all of its articles are still waiting, so a digest is never published twice; returns the published jobs
+def publish_daily_digests(jobs, parse_mode="MarkdownV2"):
+    if not jobs:
+        return []
+    telegram_ids = list({telegram_id for telegram_id, _, _ in jobs})
+    with db_connection() as connection:
+        cursor = connection.cursor()
+        connection.start_transaction()
+        try:
+            cursor.execute(f'SELECT article_id, telegram_id FROM deliveries WHERE status = %s AND telegram_id IN ({", ".join(["%s"] * len(telegram_ids))}) FOR UPDATE',
+                           (DELIVERY_WAITING, *telegram_ids))
+            waiting = set(cursor.fetchall())
+            jobs = [job for job in jobs if all((article_id, job[0]) in waiting for article_id in job[2])]
+            insert_deliveries(cursor, insert_jobs(cursor, jobs, parse_mode))
+            connection.commit()
+        finally:
+            cursor.close()
+    return jobs
+
+# Function to claim up to `limit` due jobs of the given shards for `lease` seconds, as (id, telegram id, message, parse mode) rows.
+# SKIP LOCKED lets senders claim at the same time without waiting for each other (MySQL 8.0 or newer)
+def claim_jobs(shards, limit, lease):
+    with db_connection() as connection:
+        cursor = connection.cursor()
+        connection.start_transaction()
+        cursor.execute(f'''
+            SELECT id, telegram_id, message, parse_mode FROM delivery_jobs
+            WHERE shard IN ({", ".join(["%s"] * len(shards))}) AND available_at <= NOW(3)
+            LIMIT %s FOR UPDATE SKIP LOCKED
+        ''', (*shards, limit))
+        jobs = cursor.fetchall()
+        if jobs:
+            cursor.execute(f'UPDATE delivery_jobs SET available_at = NOW(3) + INTERVAL %s SECOND, attempts = attempts + 1 WHERE id IN ({", ".join(["%s"] * len(jobs))})',
+                           (lease, *(job[0] for job in jobs)))
+        connection.commit()
+        cursor.close()
+    return jobs
+
+# Function to record sent and dead-lettered jobs in the ledger and delete them from the queue in one transaction
+def finish_jobs(sent_ids, failed_ids=()):
+    job_ids = [*sent_ids, *failed_ids]
+    if not job_ids:
+        return
+    with db_connection() as connection:
+        cursor = connection.cursor()
+        connection.start_transaction()
+        try:
+            for status, ids in ((DELIVERY_SENT, sent_ids), (DELIVERY_FAILED, failed_ids)):
+                if ids:
+                    cursor.execute(f'UPDATE deliveries SET status = %s WHERE job_id IN ({", ".join(["%s"] * len(ids))})', (status, *ids))
+            cursor.execute(f'DELETE FROM delivery_jobs WHERE id IN ({", ".join(["%s"] * len(job_ids))})', tuple(job_ids))
+            connection.commit()
+        finally:
+            cursor.close()
+
+# Function to make claimed jobs available again right away, when their sender stops before sending them
+def release_jobs(job_ids):
+    if not job_ids:
+        return
+    with db_connection() as connection:
+        cursor = connection.cursor()
+        cursor.execute(f'UPDATE delivery_jobs SET available_at = NOW(3) WHERE id IN ({", ".join(["%s"] * len(job_ids))})', tuple(job_ids))
+        cursor.close()
+
+# Function to count the jobs which were not sent yet, of the given shards or of every shard
+def count_jobs(shards=None):
+    with db_connection() as connection:
+        cursor = connection.cursor()
+        if shards is None:
+            cursor.execute('SELECT COUNT(*) FROM delivery_jobs')
+        else:
+            cursor.execute(f'SELECT COUNT(*) FROM delivery_jobs WHERE shard IN ({", ".join(["%s"] * len(shards))})', tuple(shards))
+        count = cursor.fetchone()[0]
+        cursor.close()
+    return count
+
+# Function to record a message which could not be delivered
+def insert_failed_delivery(telegram_id, message, error):
+    with db_connection() as connection:
+        cursor = connection.cursor()
+        cursor.execute('INSERT INTO failed_deliveries (telegram_id, message, error) VALUES (%s, %s, %s)',
+                       (telegram_id, message, error[:255]))
+        cursor.close()
+
+# Function to get the (username, real name) logged in with a telegram id, None without a session
+def get_session(telegram_id):
+    with db_connection() as connection:
+        cursor = connection.cursor()
+        cursor.execute('''
+            SELECT users.username, users.realname
+            FROM username_telegramID
+            INNER JOIN users ON users.username = username_telegramID.username
+            WHERE username_telegramID.telegram_id = %s
+        ''', (telegram_id,))
+        session = cursor.fetchone()
+        cursor.close()
+    return tuple(session) if session else None
 
 
 # Function to remove all articles from the articles list
 def clear_articles():
-    connection = create_connection()
-    cursor = connection.cursor()
-    try:
-        cursor.execute("DELETE FROM articles")
-        connection.commit()
-        print("All articles deleted successfully.")
-    except mysql.connector.Error as err:
-        print(f"Error while deleting articles: {err}")
-    cursor.close()
-    connection.close()
+    with db_connection() as connection:
+        cursor = connection.cursor()
+        try:
+            cursor.execute("DELETE FROM articles") # seen_links keeps the dedupe of the deleted articles
+            print("All articles deleted successfully.")
+        except mysql.connector.Error as err:
+            print(f"Error while deleting articles: {err}")
+        cursor.close()
+
+#                                               SUBSCRIPTION INDEX
+
+# In-memory boolean matrix of logged in sessions (rows) by subjects (columns).
+# Matching a batch of articles against every session is a single NumPy gather
+class SubscriptionIndex:
+    def __init__(self, rows=1024, columns=64):
+        self.lock = threading.Lock()
+        self._reset(rows, columns)
+
+    def _reset(self, rows, columns):
+        self.matrix = np.zeros((rows, columns), dtype=bool)
+        self.subject_columns = {} # Subject name -> column
+        self.session_rows = {} # Telegram id -> row
+        self.row_sessions = [] # Row -> (telegram id, username, real name), None for a free row
+        self.row_recipients = [] # Row -> (telegram id, real name, delivery mode) handed out by match()
+        self.free_rows = []
+        self.username_rows = {} # Username -> rows of all its sessions
+        self.user_subjects = {} # Username -> set of preferred subject names
+
+    def _column(self, subject_name):
+        column = self.subject_columns.get(subject_name)
+        if column is None:
+            column = len(self.subject_columns)
+            if column >= self.matrix.shape[1]:
+                self._grow(self.matrix.shape[0], self.matrix.shape[1] * 2)
+            self.subject_columns[subject_name] = column
+        return column
+
+    def _grow(self, rows, columns):
+        matrix = np.zeros((rows, columns), dtype=bool)
+        matrix[:self.matrix.shape[0], :self.matrix.shape[1]] = self.matrix
+        self.matrix = matrix
+
+    # _column() may replace the matrix when it grows, so it is called before self.matrix is read
+    def _set_subject(self, username, subject_name, value):
+        rows = list(self.username_rows.get(username, ()))
+        if rows:
+            column = self._column(subject_name)
+            self.matrix[rows, column] = value
+
+    # Replaces the whole index with sessions (telegram id, username, real name, delivery mode) and preferences (username, subject name)
+    def rebuild(self, sessions, user_preferences):
+        with self.lock:
+            # Room for every preferred subject up front, so loading doesn't have to grow the matrix
+            subject_count = len({subject_name for _, subject_name in user_preferences})
+            self._reset(max(1024, len(sessions) * 2), max(64, subject_count * 2))
+            for username, subject_name in user_preferences:
+                self.user_subjects.setdefault(username, set()).add(subject_name)
+            for telegram_id, username, realname, mode in sessions:
+                self._add_session(telegram_id, username, realname, mode)
+
+    def _add_session(self, telegram_id, username, realname, mode):
+        if telegram_id in self.session_rows:
+            self._remove_session(telegram_id)
+        if self.free_rows:
+            row = self.free_rows.pop()
+            self.row_sessions[row] = (telegram_id, username, realname)
+            self.row_recipients[row] = (telegram_id, realname, mode)
+        else:
+            row = len(self.row_sessions)
+            if row >= self.matrix.shape[0]:
+                self._grow(self.matrix.shape[0] * 2, self.matrix.shape[1])
+            self.row_sessions.append((telegram_id, username, realname))
+            self.row_recipients.append((telegram_id, realname, mode))
+        self.session_rows[telegram_id] = row
+        self.username_rows.setdefault(username, set()).add(row)
+        for subject_name in self.user_subjects.get(username, ()):
+            column = self._column(subject_name)
+            self.matrix[row, column] = True
+
+    def _remove_session(self, telegram_id):
+        row = self.session_rows.pop(telegram_id, None)
+        if row is None:
+            return
+        username = self.row_sessions[row][1]
+        self.username_rows[username].discard(row)
+        if not self.username_rows[username]:
+            del self.username_rows[username]
+            self.user_subjects.pop(username, None) # Loaded again on the next login
+        self.matrix[row, :] = False
+        self.row_sessions[row] = None
+        self.row_recipients[row] = None
+        self.free_rows.append(row)
+
+    # Called after /login or /register with the preferences of the user
+    def add_session(self, telegram_id, username, realname, subject_names, mode):
+        with self.lock:
+            self.user_subjects[username] = set(subject_names)
+            self._add_session(telegram_id, username, realname, mode)
+
+    # Called after /delivery
+    def set_delivery_mode(self, username, mode):
+        with self.lock:
+            for row in self.username_rows.get(username, ()):
+                telegram_id, _, realname = self.row_sessions[row]
+                self.row_recipients[row] = (telegram_id, realname, mode)
+
+    # Called after /logout
+    def remove_session(self, telegram_id):
+        with self.lock:
+            self._remove_session(telegram_id)
+
+    # Called after /add
+    def add_preference(self, username, subject_name):
+        with self.lock:
+            if username in self.username_rows:
+                self.user_subjects.setdefault(username, set()).add(subject_name)
+                self._set_subject(username, subject_name, True)
+
+    # Called after /remove
+    def remove_preference(self, username, subject_name):
+        with self.lock:
+            self.user_subjects.get(username, set()).discard(subject_name)
+            if subject_name in self.subject_columns:
+                self._set_subject(username, subject_name, False)
+
+    # Called after /clearpreferences
+    def clear_preferences(self, username):
+        with self.lock:
+            if username in self.user_subjects:
+                self.user_subjects[username] = set()
+            rows = list(self.username_rows.get(username, ()))
+            if rows:
+                self.matrix[rows, :] = False
+
+    # Preferred subjects of a logged in user, None when the user has no session in the index
+    def preferences(self, username):
+        with self.lock:
+            if username not in self.username_rows:
+                return None
+            return set(self.user_subjects.get(username, ()))
+
+    # Returns, for each given subject, the (telegram id, real name, delivery mode) of its subscribed sessions
+    def match(self, subject_names):
+        with self.lock:
+            columns = [self.subject_columns.get(subject_name, -1) for subject_name in subject_names]
+            known = [index for index, column in enumerate(columns) if column >= 0]
+            subscribers = [[] for _ in subject_names]
+            if not known or not self.row_sessions:
+                return subscribers
+            # One vectorised lookup of all (session, subject) hits; free rows are all False
+            hits = self.matrix[:len(self.row_sessions), [columns[index] for index in known]]
+            recipients = self.row_recipients
+            for position, index in enumerate(known):
+                subscribers[index] = [recipients[row] for row in np.flatnonzero(hits[:, position]).tolist()]
+            return subscribers
+
+    def __len__(self):
+        return len(self.session_rows)
+
+
+subscription_index = SubscriptionIndex()
+
+# Function to load the subscription index from the database
+def rebuild_subscription_index():
+    subscription_index.rebuild(get_all_sessions(), get_all_user_preferences())
+    print(f"Subscription index loaded: {len(subscription_index)} sessions")
+
+
+#                                               ASYNC DATA ACCESS
+
+# Dedicated bounded executors, so blocking MySQL calls never run on the event loop.
+# The news cycle gets its own small executor and can't take over the threads of command handlers
+NEWS_DB_WORKERS = int(os.getenv("NEWS_DB_WORKERS", "2"))
+db_executor = ThreadPoolExecutor(max_workers=max(1, db_pool.size - NEWS_DB_WORKERS), thread_name_prefix="db")
+news_executor = ThreadPoolExecutor(max_workers=NEWS_DB_WORKERS, thread_name_prefix="news")
+
+blocking_call_seconds = metric("newsbot_blocking_call_seconds", "histogram",
+                               "Seconds awaited for a blocking call, queueing for the executor included", ("function",))
+
+# Function to turn a blocking function into an awaitable running on the given executor, timing every call
+def make_async(func, executor=db_executor):
+    histogram = blocking_call_seconds.labels(func.__name__)
+    @functools.wraps(func)
+    async def wrapper(*args):
+        loop = asyncio.get_running_loop()
+        with timed(histogram):
+            return await loop.run_in_executor(executor, functools.partial(func, *args))
+    return wrapper
+
+# Awaitable versions of the data-access functions for command handlers
+async_user_exists = make_async(user_exists)
+async_insert_user = make_async(insert_user)
+async_insert_username_telegramid = make_async(insert_username_telegramid)
+async_remove_user_session = make_async(remove_user_session)
+async_get_user_realname = make_async(get_user_realname)
+async_get_user_password = make_async(get_user_password)
+async_get_user_preferences = make_async(get_user_preferences)
+async_add_user_preference = make_async(add_user_preference)
+async_get_all_subjects = make_async(get_all_subjects)
+async_remove_user_preference = make_async(remove_user_preference)
+async_clear_user_preferences = make_async(clear_user_preferences)
+async_get_session = make_async(get_session)
+async_get_delivery_mode = make_async(get_delivery_mode)
+async_set_delivery_mode = make_async(set_delivery_mode)
+
+# Function to get the subject catalogue, reloading it first when a subject was added or it expired
+async def get_subject_catalogue():
+    if subject_catalogue.expired():
+        if subject_catalogue.lock is None:
+            subject_catalogue.lock = asyncio.Lock()
+        async with subject_catalogue.lock:
+            if subject_catalogue.expired(): # Only the first waiting handler reloads it
+                subject_catalogue.load(await async_get_all_subjects())
+    return subject_catalogue
+
+# Function to get the preferred subjects of a user, from the subscription index when it has them
+async def get_preferences(username):
+    subjects = subscription_index.preferences(username)
+    if subjects is None:
+        subjects = set(await async_get_user_preferences(username))
+    return subjects
+
+# Session lookup answering from the cache without leaving the event loop
+async def async_lookup_session(telegram_id):
+    session = session_cache.get(telegram_id, NOT_CACHED)
+    if session is NOT_CACHED:
+        session = await async_get_session(telegram_id)
+        session_cache.put(telegram_id, session)
+    return session
+
+# Awaitable versions used by the news cycle
+news_insert_articles = make_async(insert_articles, news_executor)
+news_insert_failed_delivery = make_async(insert_failed_delivery, news_executor)
+news_prune_old_data = make_async(prune_old_data, news_executor)
+news_get_delivered_pairs = make_async(get_delivered_pairs, news_executor)
+news_publish_fan_out = make_async(publish_fan_out, news_executor)
+news_get_unpublished_articles = make_async(get_unpublished_articles, news_executor)
+news_get_daily_digest_items = make_async(get_daily_digest_items, news_executor)
+news_publish_daily_digests = make_async(publish_daily_digests, news_executor)
+news_claim_jobs = make_async(claim_jobs, news_executor)
+news_finish_jobs = make_async(finish_jobs, news_executor)
+news_release_jobs = make_async(release_jobs, news_executor)
+news_count_jobs = make_async(count_jobs, news_executor)
+
+
+
+
+#                                               MESSAGE RENDERING
+
+# Escape tables for MarkdownV2: in text every special symbol needs a backslash, inside a link's URL only ')' and '\\' do.
+# The backslash comes first so the escapes added for the other symbols are not escaped again
+MARKDOWNV2_ESCAPES = tuple((char, '\\' + char) for char in '\\_*[]()~`>#+-=|{}.!')
+MARKDOWNV2_LINK_ESCAPES = tuple((char, '\\' + char) for char in '\\)')
+
+# Function to apply an escape table, most fields contain only a few of its symbols so the rest are skipped after one scan
+def escape_with(table, text):
+    for char, escaped in table:
+        if char in text:
+            text = text.replace(char, escaped)
+    return text
 
 # Function to escape MarkdownV2 symbols
 def escape_markdownv2(text):
-    escape_chars = '_*[]()~`>#+-=|{}.!'
-    return ''.join(f'\\{char}' if char in escape_chars else char for char in text)
+    return escape_with(MARKDOWNV2_ESCAPES, text)
+
+# Function to escape a URL for the (...) part of a MarkdownV2 link
+def escape_markdownv2_link(url):
+    return escape_with(MARKDOWNV2_LINK_ESCAPES, url)
+
+# Article templates, the fields are filled in already escaped
+DEFAULT_ARTICLE_TEMPLATE = (
+    "*{title}*\n"
+    "_Subject: {subject}_\n"
+    "_Publication time: {time}_\n"
+    "[Read Article]({link})\n"
+    "{source}"
+)
+SOURCE_TEMPLATES = {} # Source name -> article template, sources without one use DEFAULT_ARTICLE_TEMPLATE
+
+# Function to register the article template of a news source, the escaped source name is filled in once here
+def register_template(source, template):
+    name = escape_markdownv2(source).replace("{", "{{").replace("}", "}}")
+    SOURCE_TEMPLATES[source] = template.replace("{source}", name)
+
+# Function to generate a representation of an article with escaped MarkdownV2 symbols
+# The body is the same for every recipient, so it is rendered once per article and only the greeting is per user
+def render_article(article):
+    template = SOURCE_TEMPLATES.get(article.source, DEFAULT_ARTICLE_TEMPLATE)
+    return template.format(
+        title=escape_markdownv2(article.title),
+        subject=escape_markdownv2(article.subject),
+        time=escape_markdownv2(article.publicationTime),
+        link=escape_markdownv2_link(article.link),
+        source=escape_markdownv2(article.source or ""),
+    )
+
+# Function to generate the personal line which goes before the articles, `text` is plain text
+def render_greeting(realname, text):
+    return f"{escape_markdownv2(realname)}, {escape_markdownv2(text)}"
 
 
 # Article class to hold article data
 class Article:
-    def __init__(self, title, subject, publicationTime, link):
+    def __init__(self, title, subject, publicationTime, link, source=None):
         self.title = title
         self.subject = subject
         self.publicationTime = publicationTime
         self.link = link
+        self.source = source
+        self.id = None # Set once the article is stored
+
 
 
 
+#                                               PASSWORD HASHING
+
+# bcrypt is slow on purpose, so hashing and checking run on their own bounded thread pool
+BCRYPT_ROUNDS = int(os.getenv("BCRYPT_ROUNDS", "12"))
+password_executor = ThreadPoolExecutor(max_workers=int(os.getenv("PASSWORD_WORKERS", "4")), thread_name_prefix="bcrypt")
+passwords_in_progress = set() # Telegram ids with a password being hashed or checked
+login_latency = metric("newsbot_login_password_seconds", "histogram", "Seconds spent checking a password at login").add(Histogram())
+
+# Function to hash a password with the configured work factor
+def hash_password(password):
+    return bcrypt.hashpw(password, bcrypt.gensalt(rounds=BCRYPT_ROUNDS))
+
+async_hash_password = make_async(hash_password, password_executor)
+async_check_password = make_async(bcrypt.checkpw, password_executor)
+
 
 #                                       WEB SCRAPING SERVICE
 
 
-# Scrapes BBC using CSS class heuristics with fault tolerance
-def get_latest_articles_from_bbc():
-    articles = []
-    response = requests.get("http://www.bbc.co.uk/news/")
-    soup = BeautifulSoup(response.content, 'html.parser')
-    try:
-        # Getting a list of the latest articles
-        articles_list = soup.find_all('ul', {'class': 'ssrcss-y8stko-Grid e12imr580'})
-    except Exception as e:
-        print(f"Error with receiving metadata from BBC: {e}")
-        return articles
-    if articles_list:
-        li_elements = articles_list[0].find_all('li') #Getting each article to obtain more data
-        for li in li_elements:
-                try:
-                    link = li.find('a', href=True)
-                    if link:
-                        href = link['href']
-                        if href.startswith('/'):
-                            title_element = li.find('p')
-                            subject_element = li.find('span', {'class': 'ssrcss-1pvwv4b-MetadataSnippet e4wm5bw3'})
-                            publication_time_element = li.find('span', {'class': 'visually-hidden ssrcss-1f39n02-VisuallyHidden e16en2lz0'})
-                            article_title = title_element.text if title_element else "No Title"
-                            article_subject = subject_element.text if subject_element else "Unknown"
-                            article_publicationTime = publication_time_element.text if publication_time_element else "No Time"
-                            if article_publicationTime.startswith("."): #Handling an input of Live news
-                                article_publicationTime = "Live"
-                            article_link = f"https://www.bbc.co.uk{href}"
-                            if article_title != "No Title":
-                                article = Article(article_title, article_subject, article_publicationTime, article_link)
-                                articles.append(article)
-                                if len(articles) >= 6: # Rate limiting
-                                    break
-                except Exception as ex:
-                    print(f"Error parsing BBC article: {ex}")
-    return articles
+# Shared keep-alive HTTP client for all news sources, created inside the running event loop
+http_client = None
+HTTP_RETRIES = int(os.getenv("HTTP_RETRIES", "2"))
 
-# Scrapes The Guardian using CSS class heuristics with fault tolerance
-def get_latest_articles_from_guardian():
+def get_http_client():
+    global http_client
+    if http_client is None:
+        http_client = httpx.AsyncClient(
+            http2=importlib.util.find_spec("h2") is not None, # HTTP/2 when the h2 package is installed
+            follow_redirects=True,
+            headers={"User-Agent": "UK-News-Telegram-Bot"},
+            limits=httpx.Limits(max_connections=20, max_keepalive_connections=10),
+        )
+    return http_client
+
+async def close_http_client():
+    global http_client
+    if http_client is not None:
+        await http_client.aclose()
+        http_client = None
+
+NOT_MODIFIED = object() # Returned by fetch_page when the page did not change since the last request
+
+# Function to download a page with a timeout and bounded retries; returns None when it failed.
+# The ETag/Last-Modified validators of the last stored response in `state` make the request conditional,
+# the ones of this response go into `pending` until its articles are stored
+async def fetch_page(url, timeout, state, pending):
+    headers = {}
+    if state.get("etag"):
+        headers["If-None-Match"] = state["etag"]
+    if state.get("last_modified"):
+        headers["If-Modified-Since"] = state["last_modified"]
+    for attempt in range(HTTP_RETRIES + 1):
+        try:
+            response = await get_http_client().get(url, timeout=timeout, headers=headers)
+            if response.status_code == 304:
+                return NOT_MODIFIED
+            if response.status_code < 500:
+                response.raise_for_status()
+                pending["etag"] = response.headers.get("ETag")
+                pending["last_modified"] = response.headers.get("Last-Modified")
+                return response.content
+            error = f"HTTP {response.status_code}"
+        except httpx.HTTPStatusError as e:
+            print(f"Error while downloading {url}: {e}")
+            return None
+        except httpx.HTTPError as e:
+            error = repr(e)
+        if attempt < HTTP_RETRIES:
+            await asyncio.sleep(0.5 * 2 ** attempt)
+    print(f"Error while downloading {url}: {error}")
+    return None
+
+# Function to cut the element with the given tag and class out of raw HTML without building a tree
+def extract_block(content, tag, css_class):
+    opening = re.search(rb'<%s\b[^>]*\bclass="%s"[^>]*>' % (tag.encode(), re.escape(css_class.encode())), content)
+    if opening is None:
+        return None
+    depth = 0
+    for match in re.compile(rb'<(/?)%s\b[^>]*>' % tag.encode()).finditer(content, opening.start()):
+        depth += -1 if match.group(1) else 1
+        if depth == 0:
+            return content[opening.start():match.end()]
+    return None
+
+# Function to check whether the article list of a page differs from the one of the last stored run;
+# the hash of a changed list goes into `pending`
+def list_changed(state, pending, content, tag, css_class):
+    block = extract_block(content, tag, css_class)
+    digest = hashlib.blake2b(block if block is not None else content, digest_size=16).digest()
+    if digest == state.get("hash"):
+        return False
+    pending["hash"] = digest
+    return True
+
+
+# Parser backend: lxml when it is installed, Python's built-in parser otherwise
+HTML_PARSER = "lxml" if importlib.util.find_spec("lxml") is not None else "html.parser"
+
+# Upper bound of articles taken from one page
+MAX_ARTICLES_PER_SOURCE = int(os.getenv("MAX_ARTICLES_PER_SOURCE", "50"))
+
+# Declaration of a news source: the page listing its latest articles, the class of the <ul> holding them,
+# the prefix turning relative links into absolute ones and one extractor per field.
+# An extractor gets the <li> and its <a> and returns the text of the field or None when it is missing
+class NewsSource:
+    def __init__(self, name, url, list_class, link_prefix, title, subject, publication_time,
+                 timeout=10, require_title=False, template=DEFAULT_ARTICLE_TEMPLATE):
+        self.name = name
+        self.url = url
+        self.list_class = list_class
+        self.list_strainer = SoupStrainer('ul', attrs={'class': list_class}) # Limits tree construction to the article list
+        self.link_prefix = link_prefix
+        self.title = title
+        self.subject = subject
+        self.publication_time = publication_time
+        self.timeout = timeout
+        self.require_title = require_title # Items without a title are skipped instead of sent as "No Title"
+        self.template = template
+
+NEWS_SOURCES = {} # Source name -> NewsSource, in the order they were registered
+
+# Function to add a news source to the pipeline; sources have to be registered when this module is imported,
+# because the parsing processes look them up by name in their own copy of it
+def register_source(source):
+    NEWS_SOURCES[source.name] = source
+    register_template(source.name, source.template)
+    source_state[source.name] = {}
+    source_health[source.name] = SourceHealth(source.name)
+
+# Field extractors shared by the sources
+def text_of(tag, attrs=None):
+    def extract(li, link):
+        element = li.find(tag, attrs)
+        return element.text if element else None
+    return extract
+
+def attribute_of_link(name):
+    def extract(li, link):
+        return link.get(name)
+    return extract
+
+# Health of a source as seen by its last check, so a changed layout shows up instead of a silent stream of zero articles
+class SourceHealth:
+    def __init__(self, name):
+        self.name = name
+        self.problem = None # Why the last check failed, None while the source works
+        self.failures = 0 # Checks which failed in a row
+        self.checks = 0
+        self.articles = 0 # Articles parsed over all checks
+        self.last_success = None # Time of the last check which worked
+
+    def ok(self, articles):
+        if self.problem is not None:
+            print(f"{self.name} works again after {self.failures} failed checks")
+        self.problem = None
+        self.failures = 0
+        self.checks += 1
+        self.articles += articles
+        self.last_success = datetime.now(timezone.utc)
+
+    def failed(self, problem):
+        if problem != self.problem:
+            print(f"{self.name} is unhealthy: {problem}")
+        self.problem = problem
+        self.failures += 1
+        self.checks += 1
+
+# Validators and article list hash of the last stored response of each source
+source_state = {}
+source_health = {}
+
+# Function to build the tree of the first article list of a page, None when the page has none.
+# Only the list cut out of the raw HTML is parsed when it can be found, the strainer covers the rest
+def parse_article_list(content, strainer, css_class):
+    block = extract_block(content, 'ul', css_class)
+    return BeautifulSoup(block if block is not None else content, HTML_PARSER, parse_only=strainer).find('ul')
+
+# Parses the front page of a source using its extractors with fault tolerance.
+# The lists are curated grids rather than timelines: a lead story can stay on top for hours while new ones appear
+# below it, so the whole list is walked and the seen links cache drops the known links without a query.
+# Returns (articles, problem), where problem tells why a page with a changed article list gave nothing
+def parse_articles(name, content):
+    source = NEWS_SOURCES[name]
     articles = []
-    response = requests.get("https://www.theguardian.com/uk")
-    soup = BeautifulSoup(response.content, 'html.parser')
     try:
         # Getting a list of the latest articles
-        articles_list = soup.find_all('ul', {'class': 'dcr-68r5kg'})
+        articles_list = parse_article_list(content, source.list_strainer, source.list_class)
     except Exception as e:
-        print(f"Error with receiving metadata from The Guardian: {e}")
-        return articles
-    if articles_list:
-        li_elements = articles_list[0].find_all('li') #Getting each article to obtain more data
-        for li in li_elements:
-                try:
-                    link = li.find('a', href=True)
-                    if link:
-                        href = link['href']
-                        if href.startswith('/'):
-                            title_element = link.get('aria-label')
-                            subject_element = li.find('div', {'class': 'dcr-1cc5b8d'})
-                            time_element = li.find('time')
-                            article_title = title_element if title_element else "No Title"
-                            article_subject = subject_element.text if subject_element else "Unknown"
-                            article_publicationTime = time_element.text if time_element else "No Time"
-                            article_link = f"https://www.theguardian.com{href}"
-                            article = Article(article_title, article_subject, article_publicationTime, article_link)
-                            articles.append(article)
-                            if len(articles) >= 6: # Rate limiting
-                                break
-                except Exception as e:
-                    print(f"Error parsing The Guardian article: {e}")
+        return articles, f"the page could not be parsed: {e}"
+    if articles_list is None:
+        return articles, f"no <ul class=\"{source.list_class}\"> on the page"
+    linked_items = 0
+    for li in articles_list.find_all('li'): #Getting each article to obtain more data
+        try:
+            link = li.find('a', href=True)
+            if link is None or not link['href'].startswith('/'):
+                continue
+            linked_items += 1
+            article_link = f"{source.link_prefix}{link['href']}"
+            article_title = source.title(li, link)
+            if not article_title and source.require_title:
+                continue
+            article = Article(article_title or "No Title",
+                              source.subject(li, link) or "Unknown",
+                              source.publication_time(li, link) or "No Time",
+                              article_link, name)
+            articles.append(article)
+            if len(articles) >= MAX_ARTICLES_PER_SOURCE: # Safety bound
+                break
+        except Exception as e:
+            print(f"Error parsing {name} article: {e}")
+    if linked_items == 0:
+        return articles, "the article list has no links"
+    return articles, None
+
+# Parsing is CPU-bound, so it runs in a pool of processes to use every core when there are many sources.
+# PARSE_WORKERS=0 parses on the news threads instead. Processes are started with spawn, forking a process with threads is unsafe
+PARSE_WORKERS = int(os.getenv("PARSE_WORKERS", str(min(4, os.cpu_count() or 1))))
+parse_executor = ProcessPoolExecutor(max_workers=PARSE_WORKERS, mp_context=multiprocessing.get_context("spawn")) if PARSE_WORKERS > 0 else news_executor
+
+# Awaitable parser running off the event loop
+news_parse_articles = make_async(parse_articles, parse_executor)
+
+news_stage_seconds = metric("newsbot_news_stage_seconds", "histogram", "Seconds spent in each stage of checking a source", ("source", "stage"))
+news_articles_total = metric("newsbot_news_articles_total", "counter", "New articles found", ("source",))
+metric("newsbot_news_source_healthy", "gauge", "1 when the last check of the source worked",
+       ("source",), collect=lambda: {(name, ): int(health.problem is None) for name, health in source_health.items()})
+metric("newsbot_news_source_failures", "gauge", "Checks of the source which failed in a row",
+       ("source",), collect=lambda: {(name, ): health.failures for name, health in source_health.items()})
+
+# Scrapes a source, skipping the parsing when the page or its article list did not change; None when the check failed.
+# The validators and the list hash of the page wait in state["pending"] until save_source_state() is called
+# after its articles were stored, so a page whose articles were lost is parsed again on the next check
+async def get_latest_articles(name):
+    source = NEWS_SOURCES[name]
+    state = source_state[name]
+    health = source_health[name]
+    pending = state["pending"] = {}
+    with timed(news_stage_seconds.labels(name, "fetch")):
+        content = await fetch_page(source.url, source.timeout, state, pending)
+    if content is None:
+        health.failed("the page could not be downloaded")
+        return None
+    if content is NOT_MODIFIED or not list_changed(state, pending, content, 'ul', source.list_class):
+        health.ok(0)
+        return []
+    with timed(news_stage_seconds.labels(name, "parse")):
+        articles, problem = await news_parse_articles(name, content)
+    if problem is not None:
+        pending.clear() # Fetching and parsing the same page again on the next check, the problem may be on our side
+        health.failed(problem)
+        return None
+    health.ok(len(articles))
     return articles
 
+# Function to keep the validators and the list hash of the page whose articles were just stored
+def save_source_state(name):
+    state = source_state[name]
+    state.update(state.pop("pending", {}))
+
+
+#                                       NEWS SOURCES
+
+# BBC's publication time is a visually hidden label, which starts with "." on live news
+def bbc_publication_time(li, link):
+    element = li.find('span', {'class': 'visually-hidden ssrcss-1f39n02-VisuallyHidden e16en2lz0'})
+    if element is None:
+        return None
+    return "Live" if element.text.startswith(".") else element.text
+
+register_source(NewsSource(
+    name="BBC",
+    url="http://www.bbc.co.uk/news/",
+    list_class='ssrcss-y8stko-Grid e12imr580',
+    link_prefix="https://www.bbc.co.uk",
+    title=text_of('p'),
+    subject=text_of('span', {'class': 'ssrcss-1pvwv4b-MetadataSnippet e4wm5bw3'}),
+    publication_time=bbc_publication_time,
+    timeout=float(os.getenv("BBC_TIMEOUT", "10")),
+    require_title=True,
+))
+
+register_source(NewsSource(
+    name="The Guardian",
+    url="https://www.theguardian.com/uk",
+    list_class='dcr-68r5kg',
+    link_prefix="https://www.theguardian.com",
+    title=attribute_of_link('aria-label'),
+    subject=text_of('div', {'class': 'dcr-1cc5b8d'}),
+    publication_time=text_of('time'),
+    timeout=float(os.getenv("GUARDIAN_TIMEOUT", "10")),
+))
+
 
 #                                       NOTIFICATION ENGINE
 
-# Orchestrates scraping->storage->delivery pipeline
-async def print_latest_news():
-    articles_bbc = get_latest_articles_from_bbc()
-    articles_guardian = get_latest_articles_from_guardian()
-    telegram_ids = get_all_telegram_ids()
-    if len(articles_bbc) >= 3:
-        for article in articles_bbc:
-            is_new = insert_article(article) # Checking if the article is not already in database
-            if is_new:
-                # Escaping MarkdownV2 symbols for each text
-                article.title = escape_markdownv2(article.title)
-                article.subject = escape_markdownv2(article.subject)
-                article.publicationTime = escape_markdownv2(article.publicationTime)
-                article.link = escape_markdownv2(article.link)
-                # Generating a representation of a new article
-                message = (
-                    f"*{article.title}*\n"
-                    f"_Subject: {article.subject}_\n"
-                    f"_Publication time: {article.publicationTime}_\n"
-                    f"[Read Article]({article.link})\n"
-                    f"BBC"
-                )
-                for user_id in telegram_ids:
-                    username = get_username(user_id)
-                    realname = get_user_realname(username)
-                    #Checking if the article subject is preferable for each user:
-                    if check_user_preference(username, article.subject):
-                        if article.title != "No Title" and article.title != "n/a":
-                            #Sending a personalized message
-                            await bot.send_message(chat_id=user_id, text=f"{realname}, this article may be interesting for you\\.\n" + message, parse_mode="MarkdownV2")
-
-    if len(articles_guardian) >= 3:
-        for article in articles_guardian:
-            is_new = insert_article(article) # Checking if the article is not already in database
-            if is_new:
-                # Escaping MarkdownV2 symbols for each text
-                article.title = escape_markdownv2(article.title)
-                article.subject = escape_markdownv2(article.subject)
-                article.publicationTime = escape_markdownv2(article.publicationTime)
-                article.link = escape_markdownv2(article.link)
-                # Generating a representation of a new article
-                message = (
-                    f"*{article.title}*\n"
-                    f"_Subject: {article.subject}_\n"
-                    f"_Publication time: {article.publicationTime}_\n"
-                    f"[Read Article]({article.link})\n"
-                    f"The Guardian"
-                )
-                for user_id in telegram_ids:
-                    username = get_username(user_id)
-                    realname = get_user_realname(username)
-                    # Checking if the article subject is preferable for each user:
-                    if check_user_preference(username, article.subject):
-                        if article.title != "No Title" and article.title != "n/a":
-                            await bot.send_message(chat_id=user_id,
-                                                   # Sending a personalized message
-                                                   text=f"{realname}, this article may be interesting for you.\n" + message, parse_mode="MarkdownV2")
+#                                       DELIVERY QUEUE
+
+# Token bucket allowing `rate` operations per second with bursts up to `capacity`
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        return now
+
+    # Seconds until a token is available (0 when it was taken right away)
+    def try_acquire(self):
+        now = self._refill()
+        if now < self.paused_until:
+            return self.paused_until - now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    async def acquire(self):
+        while True:
+            wait = self.try_acquire()
+            if wait == 0:
+                return
+            await asyncio.sleep(wait)
+
+    # Stops handing out tokens for the given number of seconds (Telegram's RetryAfter)
+    def pause(self, seconds):
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+
+# A message waiting in the delivery queue
+class Delivery:
+    def __init__(self, chat_id, text, parse_mode="MarkdownV2", job_id=None):
+        self.chat_id = chat_id
+        self.text = text
+        self.parse_mode = parse_mode
+        self.job_id = job_id # Row in delivery_jobs, None for messages which were not queued durably
+        self.failed = False # Dead-lettered instead of sent
+        self.next_in_chat = False # Let through by its chat, whose earlier messages were all sent
+        self.enqueued = time.monotonic()
+        self.attempts = 0
+
+
+# Queue of outgoing messages drained by concurrent workers within Telegram's flood limits
+class DeliveryQueue:
+    def __init__(self, workers, global_rate, chat_rate, max_attempts):
+        self.workers = workers
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.chat_rate = chat_rate
+        self.chat_buckets = {} # Chat id -> TokenBucket, dropped once the chat is idle
+        self.chat_backlog = {} # Chat id -> deliveries held back while one message of the chat is on its way, in order
+        self.max_attempts = max_attempts
+        self.queue = None
+        self.tasks = []
+        self.latency = Histogram() # Seconds from enqueueing to a successful send
+        self.send_time = Histogram() # Seconds per Bot API call
+        self.sent = 0
+        self.retried = 0
+        self.failed = 0
+        self.flood_waits = 0 # RetryAfter answers
+        self.on_finished = None # Called with every delivery which was sent or dead-lettered
+
+    # Starts the workers; has to be called from the running event loop
+    def start(self):
+        if self.tasks:
+            return
+        self.queue = asyncio.Queue()
+        self.chat_backlog = {}
+        self.tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def stop(self):
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks = []
+
+    def put(self, chat_id, text, parse_mode="MarkdownV2", job_id=None):
+        self.queue.put_nowait(Delivery(chat_id, text, parse_mode, job_id))
+
+    # Waits until every queued message was sent or dead-lettered
+    async def join(self):
+        await self.queue.join()
+
+    # Messages in the queue and held back behind their chat
+    def pending(self):
+        if self.queue is None:
+            return 0
+        return self.queue.qsize() + sum(len(backlog) for backlog in self.chat_backlog.values())
+
+    # Puts the next message of its chat back into the queue after a delay without letting join() finish meanwhile
+    def _defer(self, delivery, delay):
+        def requeue():
+            delivery.next_in_chat = True
+            self.queue.put_nowait(delivery)
+            self.queue.task_done()
+        asyncio.get_running_loop().call_later(delay, requeue)
+
+    # Lets the next held back message of a chat through once the previous one was sent or dead-lettered
+    def _next_in_chat(self, chat_id):
+        backlog = self.chat_backlog[chat_id]
+        if backlog:
+            self._defer(backlog.popleft(), 0)
+        else:
+            del self.chat_backlog[chat_id]
+
+    def _chat_bucket(self, chat_id):
+        bucket = self.chat_buckets.get(chat_id)
+        if bucket is None:
+            if len(self.chat_buckets) > 10000: # Forgetting chats which have a full bucket again
+                for idle_chat_id in [key for key, value in self.chat_buckets.items() if value._refill() and value.tokens >= value.capacity]:
+                    del self.chat_buckets[idle_chat_id]
+            bucket = self.chat_buckets[chat_id] = TokenBucket(self.chat_rate, 1)
+        return bucket
+
+    # One message per chat is on its way at a time, the chat's later messages wait in its backlog, so a chat
+    # gets its messages in the order they were queued even when one of them has to wait or be retried
+    async def _worker(self):
+        while True:
+            delivery = await self.queue.get()
+            if delivery.next_in_chat:
+                delivery.next_in_chat = False
+            elif delivery.chat_id in self.chat_backlog:
+                self.chat_backlog[delivery.chat_id].append(delivery) # Still unfinished for join()
+                continue
+            else:
+                self.chat_backlog[delivery.chat_id] = deque()
+            # Messages to a busy chat are set aside instead of blocking the worker
+            wait = self._chat_bucket(delivery.chat_id).try_acquire()
+            if wait > 0:
+                self._defer(delivery, wait)
+                continue
+            await self.global_bucket.acquire()
+            retry_in = await self._send(delivery)
+            if retry_in is None:
+                if self.on_finished is not None:
+                    self.on_finished(delivery)
+                self._next_in_chat(delivery.chat_id)
+                self.queue.task_done()
+            else:
+                self.retried += 1
+                self._defer(delivery, retry_in)
+
+    # Sends a message; returns the delay before the next attempt or None when the delivery is finished
+    async def _send(self, delivery):
+        delivery.attempts += 1
+        try:
+            with timed(self.send_time):
+                await bot.send_message(chat_id=delivery.chat_id, text=delivery.text, parse_mode=delivery.parse_mode)
+        except RetryAfter as e:
+            self.flood_waits += 1
+            delay = e.retry_after.total_seconds() if isinstance(e.retry_after, timedelta) else e.retry_after
+            print(f"Flood limit reached, retrying in {delay} seconds")
+            self.global_bucket.pause(delay)
+            delivery.attempts -= 1 # Flood waits don't count as failed attempts
+            return delay
+        except (Forbidden, BadRequest) as e:
+            # Blocked bot, deleted chat or malformed message: retrying won't help
+            await self._dead_letter(delivery, str(e))
+        except NetworkError as e:
+            if delivery.attempts < self.max_attempts:
+                return min(60, 2 ** delivery.attempts)
+            await self._dead_letter(delivery, str(e))
+        except Exception as e:
+            await self._dead_letter(delivery, str(e))
+        else:
+            self.sent += 1
+            self.latency.observe(time.monotonic() - delivery.enqueued)
+        return None
+
+    async def _dead_letter(self, delivery, error):
+        self.failed += 1
+        delivery.failed = True
+        print(f"Failed to deliver a message to {delivery.chat_id}: {error}")
+        try:
+            await news_insert_failed_delivery(delivery.chat_id, delivery.text, error)
+        except Exception as err:
+            print(f"Error while recording a failed delivery: {err}")
+
+    # Snapshot of the delivery counters for monitoring
+    def stats(self):
+        return {
+            "queued": self.pending(),
+            "sent": self.sent,
+            "retried": self.retried,
+            "failed": self.failed,
+            "flood_waits": self.flood_waits,
+            "latency_seconds_p50": self.latency.percentile(50),
+            "latency_seconds_p99": self.latency.percentile(99),
+        }
+
+
+DELIVERY_MODES = ("instant", "digest", "daily")
+DEFAULT_DELIVERY_MODE = os.getenv("DEFAULT_DELIVERY_MODE", "digest")
+DAILY_DIGEST_HOUR = int(os.getenv("DAILY_DIGEST_HOUR", "8"))
+MESSAGE_LIMIT = 4096 # Telegram's maximum message length
+
+# Function to join a greeting and (article id, rendered article) items into as few messages as Telegram's length limit allows;
+# returns (message, article ids) pairs
+def build_digest(greeting, items):
+    digest = []
+    current, article_ids = greeting, []
+    for article_id, message in items:
+        if len(current) + 2 + len(message) > MESSAGE_LIMIT and current is not greeting:
+            digest.append((current, article_ids))
+            current, article_ids = message, []
+        else:
+            current = f"{current}\n\n{message}"
+        article_ids.append(article_id)
+    digest.append((current, article_ids))
+    return digest
+
+# Function to build the digest of one user as (telegram id, message, article ids) jobs
+def digest_jobs(user_id, realname, items, single, multiple):
+    greeting = render_greeting(realname, single if len(items) == 1 else multiple)
+    return [(user_id, text, article_ids) for text, article_ids in build_digest(greeting, items)]
+
+
+# Which process does what: "bot" answers commands, "ingest" checks the sources and publishes delivery jobs,
+# "sender" sends the jobs of its shards, "all" does everything in one process
+ROLE = os.getenv("ROLE", "all")
+ROLES = ("bot", "ingest", "sender", "all")
+# Sender SENDER_INDEX of SENDER_COUNT takes the shards whose number modulo SENDER_COUNT is SENDER_INDEX
+SENDER_INDEX = int(os.getenv("SENDER_INDEX", "0"))
+SENDER_COUNT = int(os.getenv("SENDER_COUNT", "1"))
+JOB_BATCH = int(os.getenv("JOB_BATCH", "200")) # Jobs claimed at once
+JOB_LEASE = int(os.getenv("JOB_LEASE", "300")) # Seconds a claimed job stays hidden from other senders
+JOB_POLL_INTERVAL = float(os.getenv("JOB_POLL_INTERVAL", "1")) # Seconds between claims while the queue is empty
+
+# Function to tell whether this process has the given role
+def has_role(role):
+    return ROLE == role or ROLE == "all"
+
+delivery_queue = DeliveryQueue(
+    workers=int(os.getenv("SEND_WORKERS", "16")),
+    global_rate=float(os.getenv("TELEGRAM_GLOBAL_RATE", "30")) / SENDER_COUNT, # The flood limit is per bot, shared by all senders
+    chat_rate=float(os.getenv("TELEGRAM_CHAT_RATE", "1")),
+    max_attempts=int(os.getenv("SEND_MAX_ATTEMPTS", "5")),
+)
+
+metric("newsbot_messages_total", "counter", "Messages by outcome: sent, retried, failed or flood_wait (RetryAfter)", ("result",),
+       collect=lambda: {("sent",): delivery_queue.sent, ("retried",): delivery_queue.retried,
+                        ("failed",): delivery_queue.failed, ("flood_wait",): delivery_queue.flood_waits})
+metric("newsbot_messages_queued", "gauge", "Messages waiting to be sent",
+       collect=delivery_queue.pending)
+metric("newsbot_send_seconds", "histogram", "Seconds per Bot API send call").add(delivery_queue.send_time)
+metric("newsbot_delivery_latency_seconds", "histogram", "Seconds from queueing a message to sending it").add(delivery_queue.latency)
+
+jobs_total = metric("newsbot_jobs_total", "counter", "Delivery jobs published, claimed and finished by this process", ("event",))
+ledger_rows_total = metric("newsbot_ledger_rows_total", "counter", "Rows written to the delivery ledger by this process, by status", ("status",))
+
+# Feeds the delivery queue from the shards of this sender in delivery_jobs. Once a job is sent or dead-lettered, its ledger rows
+# are marked and the job is deleted in one transaction, so a finished job is never claimed again. A job whose sender dies
+# before that comes back when its lease runs out, which leaves the messages in flight at the moment of a crash to be sent twice
+class JobConsumer:
+    def __init__(self, delivery_queue, shards, batch=JOB_BATCH, lease=JOB_LEASE, poll_interval=JOB_POLL_INTERVAL):
+        self.delivery_queue = delivery_queue
+        self.shards = shards
+        self.batch = batch
+        self.lease = lease
+        self.poll_interval = poll_interval
+        self.in_flight = set() # Claimed job ids in the delivery queue; claiming one of them again only renews its lease
+        self.finished = [] # (job id, failed) of jobs which were sent or dead-lettered, recorded with the next flush
+        delivery_queue.on_finished = self._finished
+
+    def _finished(self, delivery):
+        if delivery.job_id is not None:
+            self.finished.append((delivery.job_id, delivery.failed))
+
+    # Records the finished jobs in the ledger and deletes them in one transaction
+    async def flush(self):
+        if not self.finished:
+            return
+        finished, self.finished = self.finished, []
+        sent_ids = [job_id for job_id, failed in finished if not failed]
+        failed_ids = [job_id for job_id, failed in finished if failed]
+        try:
+            await news_finish_jobs(sent_ids, failed_ids)
+        except Exception:
+            self.finished.extend(finished) # Trying again with the next flush
+            raise
+        self.in_flight.difference_update(sent_ids + failed_ids)
+        jobs_total.labels("finished").inc(len(finished))
+        ledger_rows_total.labels("sent").inc(len(sent_ids))
+        ledger_rows_total.labels("failed").inc(len(failed_ids))
+
+    async def run(self):
+        while True:
+            try:
+                await self.flush()
+                if self.delivery_queue.pending() >= self.batch: # Claiming more would only let the leases run out in memory
+                    await asyncio.sleep(0.1)
+                    continue
+                jobs = await news_claim_jobs(self.shards, self.batch, self.lease)
+            except Exception as e:
+                print(f"Error while claiming delivery jobs: {e}")
+                await asyncio.sleep(self.poll_interval)
+                continue
+            jobs_total.labels("claimed").inc(len(jobs))
+            for job_id, telegram_id, message, parse_mode in jobs:
+                if job_id not in self.in_flight:
+                    self.in_flight.add(job_id)
+                    self.delivery_queue.put(telegram_id, message, parse_mode, job_id)
+            if len(jobs) < self.batch:
+                await asyncio.sleep(self.poll_interval)
+
+    # Deletes what was sent and hands the jobs which are still in memory back to the other senders
+    async def stop(self):
+        await self.flush()
+        unsent = list(self.in_flight)
+        self.in_flight.clear()
+        await news_release_jobs(unsent)
+
+job_consumer = JobConsumer(delivery_queue, [shard for shard in range(JOB_SHARDS) if shard % SENDER_COUNT == SENDER_INDEX])
+
+# Function to wait until the published jobs of this sender's shards were sent; needs the sender role running in this process,
+# so it only waits for every job with SENDER_COUNT=1, e.g. in the load test with ROLE=all
+async def wait_for_deliveries(poll_interval=0.5):
+    if delivery_queue.queue is None:
+        raise RuntimeError("waiting for deliveries needs the sender role running in this process")
+    while await news_count_jobs(job_consumer.shards) > 0:
+        await asyncio.sleep(poll_interval)
+    await delivery_queue.join()
+    await job_consumer.flush()
+
+
+
+source_locks = {name: asyncio.Lock() for name in NEWS_SOURCES} # One run of each source at a time
+fan_out_pending = True # Whether stored articles may lack their fan-out: at start and after a fan-out failed
+fanning_out = set() # Ids of the articles this process is fanning out right now
+resume_lock = asyncio.Lock() # One resume of the stored articles at a time
+
+# Function to store the scraped articles of a source and queue the new ones for their subscribers, returns how many were new
+async def deliver_articles(source, articles):
+    global fan_out_pending
+    # Storing the whole batch at once, only articles which were not in the database come back
+    with timed(news_stage_seconds.labels(source, "store")):
+        new_articles = await news_insert_articles(articles)
+    if not new_articles:
+        return 0
+    news_articles_total.labels(source).inc(len(new_articles))
+    with timed(news_stage_seconds.labels(source, "fanout")):
+        article_ids = [article.id for article in new_articles]
+        fanning_out.update(article_ids)
+        try:
+            await fan_out(new_articles)
+        except Exception:
+            # The articles are stored, so no later check of the page returns them; resume_fan_out publishes them instead
+            fan_out_pending = True
+            raise
+        finally:
+            fanning_out.difference_update(article_ids)
+    return len(new_articles)
+
+# Function to match new articles against their subscribers and render them in each session's delivery mode;
+# returns the (telegram id, message, article ids) jobs and the (telegram id, article id) pairs waiting for the daily digest.
+# Pairs in `delivered` were published by an interrupted fan-out and are skipped.
+# It runs on the news threads, rendering for every session would stall the event loop
+def build_fan_out(new_articles, delivered=frozenset()):
+    subject_names = [article.subject for article in new_articles]
+    if has_role("bot"):
+        # Matching all new articles against every logged in session at once; the handlers of this process keep the index current
+        subscribers = subscription_index.match(subject_names)
+    else:
+        # The handlers run in another process, so the subscribers come from the database in one query
+        by_subject = get_subject_subscribers(list(set(subject_names)))
+        subscribers = [by_subject[subject_name] for subject_name in subject_names]
+    jobs = [] # (telegram id, message, article ids)
+    digests = {} # Telegram id -> (real name, (article id, rendered article) items) for the per-cycle digests
+    waiting = [] # (telegram id, article id) for the daily digests
+    for article, article_subscribers in zip(new_articles, subscribers):
+        if article.title == "No Title" or article.title == "n/a":
+            continue
+        message = render_article(article)
+        for user_id, realname, mode in article_subscribers:
+            if (article.id, user_id) in delivered:
+                continue
+            if mode == "instant":
+                #Queueing a personalized message
+                jobs.append((user_id, render_greeting(realname, "this article may be interesting for you.") + "\n" + message, [article.id]))
+            elif mode == "daily":
+                waiting.append((user_id, article.id))
+            else:
+                digests.setdefault(user_id, (realname, []))[1].append((article.id, message))
+    for user_id, (realname, items) in digests.items():
+        jobs.extend(digest_jobs(user_id, realname, items, "this article may be interesting for you.", "these articles may be interesting for you."))
+    return jobs, waiting
+
+news_build_fan_out = make_async(build_fan_out, news_executor)
+
+# Function to publish new articles for every session subscribed to their subjects, in the session's delivery mode.
+# The jobs are written with their ledger rows in chunks of sessions and the articles' fanned_out flag with the last chunk, so
+# a fan-out which was interrupted is finished by resume_fan_out for the sessions it missed and one which was published is never published again
+async def fan_out(new_articles):
+    article_ids = [article.id for article in new_articles]
+    delivered = await news_get_delivered_pairs(article_ids)
+    jobs, waiting = await news_build_fan_out(new_articles, delivered)
+    try:
+        published = await news_publish_fan_out(article_ids, jobs, waiting)
+    except LedgerRace:
+        print("Another run published part of this fan-out, matching it again")
+        await fan_out(new_articles)
+        return
+    if published:
+        # Another run got some of these articles first; the rest is matched again without them
+        print(f"{len(published)} articles were fanned out already, publishing the others again")
+        remaining = [article for article in new_articles if article.id not in published]
+        if remaining:
+            await fan_out(remaining)
+        return
+    jobs_total.labels("published").inc(len(jobs))
+    ledger_rows_total.labels("queued").inc(sum(len(article_ids) for _, _, article_ids in jobs))
+    ledger_rows_total.labels("waiting").inc(len(waiting))
+
+# Function to publish the fan-out of the stored articles which never got one, without scraping them again.
+# It does nothing unless a fan-out may be missing, and skips the articles whose fan-out is still running in this process
+async def resume_fan_out():
+    global fan_out_pending
+    if not fan_out_pending or resume_lock.locked():
+        return
+    async with resume_lock:
+        fan_out_pending = False
+        try:
+            articles = [article for article in await news_get_unpublished_articles() if article.id not in fanning_out]
+            if articles:
+                print(f"Resuming the fan-out of {len(articles)} stored articles")
+                await fan_out(articles)
+        except Exception:
+            fan_out_pending = True
+            raise
+
+# Orchestrates scraping->storage->delivery pipeline of one source; returns how many articles were new or None when the source failed
+async def run_source(source):
+    lock = source_locks[source]
+    if lock.locked(): # The previous run is still going, starting another would deliver the same articles twice
+        print(f"{source} is still being checked, skipping this run")
+        return 0
+    async with lock:
+        with timed(news_stage_seconds.labels(source, "total")):
+            articles = await get_latest_articles(source)
+            if articles is None:
+                return None
+            new_articles = await deliver_articles(source, articles)
+            save_source_state(source)
+            return new_articles
+
+# Function to check one source, after publishing what an earlier check stored but did not fan out
+async def check_source(source):
+    try:
+        await resume_fan_out()
+    except Exception as e: # The source is still checked, the resume is tried again at the next check
+        print(f"Error while resuming the fan-out of stored articles: {e}")
+    return await run_source(source)
 
+# Checks every source once and waits until the published messages are sent, see wait_for_deliveries
+async def print_latest_news():
+    results = await asyncio.gather(*(run_source(source) for source in NEWS_SOURCES))
+    await wait_for_deliveries()
+    return results
+
+# Function to publish the daily digests of every session which has articles waiting
+async def send_daily_digests():
+    digests = {}
+    for user_id, realname, article in await news_get_daily_digest_items():
+        digests.setdefault(user_id, (realname, []))[1].append((article.id, render_article(article)))
+    jobs = []
+    for user_id, (realname, items) in digests.items():
+        jobs.extend(digest_jobs(user_id, realname, items, "here is your daily digest.", "here is your daily digest."))
+    published = await news_publish_daily_digests(jobs)
+    jobs_total.labels("published").inc(len(published))
+    ledger_rows_total.labels("queued").inc(sum(len(article_ids) for _, _, article_ids in published))
+    print(f"Daily digests published for {len(digests)} users")
+
+# Function to send daily digests every day at DAILY_DIGEST_HOUR (UTC)
+async def daily_digests():
+    while True:
+        now = datetime.now(timezone.utc)
+        next_run = now.replace(hour=DAILY_DIGEST_HOUR, minute=0, second=0, microsecond=0)
+        if next_run <= now:
+            next_run += timedelta(days=1)
+        await asyncio.sleep((next_run - now).total_seconds())
+        try:
+            await send_daily_digests()
+        except Exception as e:
+            print(f"Error while sending daily digests: {e}")
 
 
 
@@ -470,31 +2429,45 @@ async def print_latest_news():
 
 REGISTER_USERNAME, REGISTER_REALNAME, REGISTER_PASSWORD, LOGIN_USERNAME, LOGIN_PASSWORD = range(5)
 
+handler_seconds = metric("newsbot_handler_seconds", "histogram", "Seconds spent handling an update", ("handler",))
+
+# Decorator timing every call of a handler
+def timed_handler(handler):
+    histogram = handler_seconds.labels(handler.__name__)
+    @functools.wraps(handler)
+    async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        with timed(histogram):
+            return await handler(update, context)
+    return wrapper
+
 # A function dealing with /start command
+@timed_handler
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     telegram_id = update.message.from_user.id
-    if not check_session(telegram_id):
+    if await async_lookup_session(telegram_id) is None:
         await update.message.reply_text("Welcome\\! Are you a new user or existing user?\nType */register* or */login*\nIf you need to cancel current operation, type */cancel*",parse_mode="MarkdownV2")
     else:
         await update.message.reply_text("Welcome back\\! You are already logged in\\. Type */info* to get details about your account\\.\nIf you need to cancel current operation, type */cancel*",parse_mode="MarkdownV2")
         return ConversationHandler.END
 
 #A function dealing with /info command
+@timed_handler
 async def info(update: Update, context: ContextTypes.DEFAULT_TYPE):
     telegram_id = update.message.from_user.id
-    if not check_session(telegram_id):
+    session = await async_lookup_session(telegram_id)
+    if session is None:
         await update.message.reply_text(
             f"You are not logged in\\. Type */register* or */login* to log in or register\\.\nIf you need to cancel current operation, type */cancel*",parse_mode="MarkdownV2")
         return ConversationHandler.END
-    username = get_username(telegram_id)
-    realname = get_user_realname(username)
-    await update.message.reply_text(f"Your account details are as follows:\nUsername: {username}\nReal name: {realname}\nType */logout* to log out",parse_mode="MarkdownV2")
+    username, realname = session
+    await update.message.reply_text(f"Your account details are as follows:\nUsername: {escape_markdownv2(username)}\nReal name: {escape_markdownv2(realname)}\nType */logout* to log out",parse_mode="MarkdownV2")
     return ConversationHandler.END
 
 # Finite state machine for user registration
+@timed_handler
 async def register(update: Update, context: ContextTypes.DEFAULT_TYPE):
     telegram_id = update.message.from_user.id
-    if check_session(telegram_id):
+    if await async_lookup_session(telegram_id) is not None:
         await update.message.reply_text("You are already logged in\\. Type */info* to get details about your account\\.\nIf you need to cancel current operation, type */cancel*",parse_mode="MarkdownV2")
         return ConversationHandler.END
     else:
@@ -502,9 +2475,10 @@ async def register(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return REGISTER_USERNAME
 
 # Function handling /login command
+@timed_handler
 async def login(update: Update, context: ContextTypes.DEFAULT_TYPE):
     telegram_id = update.message.from_user.id
-    if check_session(telegram_id):
+    if await async_lookup_session(telegram_id) is not None:
         print("User already logged in")
         await update.message.reply_text(
             "You are already logged in\\. Type */info* to get details about your account\\.\nIf you need to cancel current operation, type */cancel*",parse_mode="MarkdownV2")
@@ -514,23 +2488,28 @@ async def login(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return LOGIN_USERNAME
 
 #Function handling /logout command
+@timed_handler
 async def logout(update: Update, context: ContextTypes.DEFAULT_TYPE):
     telegram_id = update.message.from_user.id
-    if check_session(telegram_id):
-        remove_user_session(telegram_id)
+    if await async_lookup_session(telegram_id) is not None:
+        await async_remove_user_session(telegram_id)
+        session_cache.put(telegram_id, None)
+        subscription_index.remove_session(telegram_id)
         await update.message.reply_text("You have been logged out successfully.")
     else:
         await update.message.reply_text("You are not logged in.")
     return ConversationHandler.END
 
 #Function handling /preferences command
+@timed_handler
 async def preferences(update: Update, context: ContextTypes.DEFAULT_TYPE):
     telegram_id = update.message.from_user.id
-    if check_session(telegram_id):
-        username = get_username(telegram_id)
-        user_preferences = get_user_preferences(username)
+    session = await async_lookup_session(telegram_id)
+    if session is not None:
+        username = session[0]
+        user_preferences = sorted(await get_preferences(username))
         pref_text = "\n".join(user_preferences) if user_preferences else "No preferences"
-        subj_text = "\n".join(get_all_subjects())
+        subj_text = "\n".join((await get_subject_catalogue()).names)
         await update.message.reply_text(
             f"Your current preferences:\n{pref_text}\n\n"
             f"Available subjects:\n{subj_text}\n\n"
@@ -548,11 +2527,14 @@ async def preferences(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return ConversationHandler.END
 
 # Function to clear all user's preferences from the database
+@timed_handler
 async def clearpreferences(update: Update, context: ContextTypes.DEFAULT_TYPE):
     telegram_id = update.message.from_user.id
-    if check_session(telegram_id):
-        username = get_username(telegram_id)
-        clear_user_preferences(username)
+    session = await async_lookup_session(telegram_id)
+    if session is not None:
+        username = session[0]
+        await async_clear_user_preferences(username)
+        subscription_index.clear_preferences(username)
         await update.message.reply_text("Your preferences have been cleared successfully.")
         return ConversationHandler.END
     else:
@@ -561,25 +2543,28 @@ async def clearpreferences(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return ConversationHandler.END
 
 # Function handling /add command to add user's preference to the database
+@timed_handler
 async def add(update: Update, context: ContextTypes.DEFAULT_TYPE):
     telegram_id = update.message.from_user.id
-    if check_session(telegram_id):
-        username = get_username(telegram_id)
+    session = await async_lookup_session(telegram_id)
+    if session is not None:
+        username = session[0]
         if not context.args:
             await update.message.reply_text("Please specify a subject to add. Example: /add Middle East")
             return
 
-        subject = ' '.join(context.args)
-        if subject in get_all_subjects():
-            if not check_user_preference(username, subject):
-                add_user_preference(username, subject)
+        subject = (await get_subject_catalogue()).resolve(' '.join(context.args))
+        if subject is not None:
+            if subject not in await get_preferences(username):
+                await async_add_user_preference(username, subject)
+                subscription_index.add_preference(username, subject)
                 await update.message.reply_text(f"Preference added successfully: {subject}")
                 return ConversationHandler.END
             else:
                 await update.message.reply_text(f"Subject is already in your list of preferences.")
                 return ConversationHandler.END
         else:
-            await update.message.reply_text(f"Invalid subject: {subject}")
+            await update.message.reply_text(f"Invalid subject: {' '.join(context.args)}")
             return ConversationHandler.END
     else:
         await update.message.reply_text(
@@ -587,24 +2572,27 @@ async def add(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return ConversationHandler.END
 
 # Function handling /remove command to remove user's preference from the database
+@timed_handler
 async def remove(update: Update, context: ContextTypes.DEFAULT_TYPE):
     telegram_id = update.message.from_user.id
-    if check_session(telegram_id):
-        username = get_username(telegram_id)
+    session = await async_lookup_session(telegram_id)
+    if session is not None:
+        username = session[0]
         if not context.args:
             await update.message.reply_text("Please specify a subject to remove. Example: /remove Middle East")
             return
-        subject = ' '.join(context.args)
-        if subject in get_all_subjects():
-            if check_user_preference(username, subject):
-                remove_user_preference(username, subject)
+        subject = (await get_subject_catalogue()).resolve(' '.join(context.args))
+        if subject is not None:
+            if subject in await get_preferences(username):
+                await async_remove_user_preference(username, subject)
+                subscription_index.remove_preference(username, subject)
                 await update.message.reply_text(f"Preference removed successfully: {subject}")
                 return ConversationHandler.END
             else:
                 await update.message.reply_text(f"Subject is not in your list of preferences to remove it.")
                 return ConversationHandler.END
         else:
-            await update.message.reply_text(f"Invalid subject: {subject}")
+            await update.message.reply_text(f"Invalid subject: {' '.join(context.args)}")
             return ConversationHandler.END
     else:
         await update.message.reply_text(
@@ -613,11 +2601,40 @@ async def remove(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 
 
+# Function handling /delivery command to choose how articles are delivered
+@timed_handler
+async def delivery(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    telegram_id = update.message.from_user.id
+    session = await async_lookup_session(telegram_id)
+    if session is None:
+        await update.message.reply_text(
+            f"You are not logged in\\. Type */register* or */login* to log in or register\\.\nIf you need to cancel current operation, type */cancel*",parse_mode="MarkdownV2")
+        return ConversationHandler.END
+    username = session[0]
+    if not context.args:
+        mode = await async_get_delivery_mode(username)
+        await update.message.reply_text(
+            f"Your delivery mode: {mode}\n"
+            "instant - one message per article\n"
+            "digest - one message with all new articles of each news check\n"
+            f"daily - one message a day at {DAILY_DIGEST_HOUR}:00 UTC\n"
+            "Change it with /delivery mode, e.g. /delivery digest")
+        return ConversationHandler.END
+    mode = context.args[0].lower()
+    if mode not in DELIVERY_MODES:
+        await update.message.reply_text(f"Invalid delivery mode: {mode}. Choose instant, digest or daily.")
+        return ConversationHandler.END
+    await async_set_delivery_mode(username, mode)
+    subscription_index.set_delivery_mode(username, mode)
+    await update.message.reply_text(f"Delivery mode changed to {mode}.")
+    return ConversationHandler.END
+
+
 # Function for username handling
+@timed_handler
 async def register_username(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    users = get_all_usernames()
     username = update.message.text
-    if username in users:
+    if await async_user_exists(username):
         await update.message.reply_text("Username already exists. Try a different one.")
         return REGISTER_USERNAME
     context.user_data["username"] = username
@@ -625,27 +2642,38 @@ async def register_username(update: Update, context: ContextTypes.DEFAULT_TYPE):
     return REGISTER_REALNAME
 
 # Function to get user's real name
+@timed_handler
 async def register_realname(update: Update, context: ContextTypes.DEFAULT_TYPE):
     context.user_data["realname"] = update.message.text
     await update.message.reply_text("Choose a password:")
     return REGISTER_PASSWORD
 
 # Function for secure password handling with bcrypt
+@timed_handler
 async def register_password(update: Update, context: ContextTypes.DEFAULT_TYPE):
     password = update.message.text.encode("utf-8")
-    hashed = bcrypt.hashpw(password, bcrypt.gensalt())
     username = context.user_data["username"]
     telegram_id = update.message.from_user.id
-    insert_user(username, context.user_data["realname"], hashed)
-    insert_username_telegramid(telegram_id, username)
-    await update.message.reply_text(f"Thanks for registering, {context.user_data['realname']}\\!\nTo get news articles from the leading websites, set your preferences by typing */preferences*",parse_mode="MarkdownV2")
+    if telegram_id in passwords_in_progress:
+        await update.message.reply_text("Your password is still being processed, please wait.")
+        return REGISTER_PASSWORD
+    passwords_in_progress.add(telegram_id)
+    try:
+        hashed = await async_hash_password(password)
+    finally:
+        passwords_in_progress.discard(telegram_id)
+    await async_insert_user(username, context.user_data["realname"], hashed)
+    await async_insert_username_telegramid(telegram_id, username)
+    session_cache.put(telegram_id, (username, context.user_data["realname"]))
+    subscription_index.add_session(telegram_id, username, context.user_data["realname"], [], DEFAULT_DELIVERY_MODE)
+    await update.message.reply_text(f"Thanks for registering, {escape_markdownv2(context.user_data['realname'])}\\!\nTo get news articles from the leading websites, set your preferences by typing */preferences*",parse_mode="MarkdownV2")
     return ConversationHandler.END
 
 # Function handling username login
+@timed_handler
 async def login_username(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    users = get_all_usernames()
     username = update.message.text
-    if username not in users:
+    if not await async_user_exists(username):
         await update.message.reply_text("Username not found. Try again:")
         return LOGIN_USERNAME
     context.user_data["username"] = username
@@ -653,27 +2681,43 @@ async def login_username(update: Update, context: ContextTypes.DEFAULT_TYPE):
     return LOGIN_PASSWORD
 
 # Function handling password login
+@timed_handler
 async def login_password(update: Update, context: ContextTypes.DEFAULT_TYPE):
     telegram_id = update.message.from_user.id
     password = update.message.text.encode("utf-8")
     username = context.user_data["username"]
-    stored = get_user_password(username)
-    realname = get_user_realname(username)
-
-    if bcrypt.checkpw(password, stored):
+    if telegram_id in passwords_in_progress: # One check at a time per telegram id against brute force
+        await update.message.reply_text("Your previous attempt is still being checked, please wait.")
+        return LOGIN_PASSWORD
+    passwords_in_progress.add(telegram_id)
+    try:
+        stored = await async_get_user_password(username)
+        realname = await async_get_user_realname(username)
+        started = time.monotonic()
+        correct = await async_check_password(password, stored)
+        login_latency.observe(time.monotonic() - started)
+    finally:
+        passwords_in_progress.discard(telegram_id)
+
+    if correct:
         await update.message.reply_text(f"Welcome back, {realname}!")
-        insert_username_telegramid(telegram_id, username)
+        await async_insert_username_telegramid(telegram_id, username)
+        session_cache.put(telegram_id, (username, realname))
+        subscription_index.add_session(telegram_id, username, realname, await async_get_user_preferences(username),
+                                       await async_get_delivery_mode(username))
         return ConversationHandler.END
     else:
         await update.message.reply_text("Incorrect password. Try again:")
         return LOGIN_PASSWORD
 
 # Function handling /cancel command to cancel user's current operations
+@timed_handler
 async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text("All current operations are cancelled.")
     return ConversationHandler.END
 
 # Function to deal with unknown commands
+@timed_handler
 async def unknown_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text(
         "Unknown command\\.\n"
@@ -681,12 +2725,14 @@ async def unknown_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     )
 
 # Function to deal with unknown messages to bot
+@timed_handler
 async def unknown_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text(
         "I only understand specific commands\\.\nType */help* to see what I can do\\.",parse_mode="MarkdownV2"
     )
 
 # Function handling /commands to send a list of available commands
+@timed_handler
 async def commands(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text(
         "Here are the available commands:\n\n"
@@ -699,22 +2745,247 @@ async def commands(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "*/add* _subject_ \\- Add a preference\n"
         "*/remove* _subject_ \\- Remove a preference\n"
         "*/clearpreferences* \\- Clear the list of your preferences\n"
+        "*/delivery* _mode_ \\- Get articles instantly, as a digest or daily\n"
         "*/cancel* \\- Cancel current operation\n",
         parse_mode="MarkdownV2"
     )
 
-# Function to systematically check websites for new articles and notify users each hour
-async def check_news():
+# Telegram ids allowed to use /stats
+ADMIN_TELEGRAM_IDS = {int(telegram_id) for telegram_id in os.getenv("ADMIN_TELEGRAM_IDS", "").replace(",", " ").split()}
+
+# Function to describe a histogram in one short line
+def describe_latency(histogram):
+    return f"p50 {histogram.percentile(50)}s, p99 {histogram.percentile(99)}s, {histogram.count} calls"
+
+# Function handling /stats command, which shows where the time of the news checks goes; admins only
+@timed_handler
+async def stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.message.from_user.id not in ADMIN_TELEGRAM_IDS:
+        return await unknown_command(update, context)
+    lines = ["News sources:"]
+    for name, health in source_health.items():
+        status = "ok" if health.problem is None else f"failing ({health.failures}x): {health.problem}"
+        lines.append(f"{name}: {status}, checked every {source_schedules[name].interval:.0f}s, {health.articles} articles parsed")
+        for stage in ("fetch", "parse", "store", "fanout", "total"):
+            histogram = news_stage_seconds.children.get((name, stage))
+            if histogram is not None and histogram.count:
+                lines.append(f"  {stage}: {describe_latency(histogram)}")
+    queue_stats = delivery_queue.stats()
+    lines.append("")
+    lines.append(f"Delivery: {queue_stats['sent']} sent, {queue_stats['retried']} retried, {queue_stats['failed']} failed, "
+                 f"{queue_stats['flood_waits']} flood waits, {queue_stats['queued']} queued")
+    lines.append(f"  send call: {describe_latency(delivery_queue.send_time)}")
+    lines.append(f"  queue to sent: {describe_latency(delivery_queue.latency)}")
+    lines.append("")
+    lines.append(f"Database: {db_pool.in_use}/{db_pool.size} connections in use, waiting for one {describe_latency(db_pool.wait_time)}")
+    for title, family in (("Slowest blocking calls (p99):", blocking_call_seconds), ("Slowest handlers (p99):", handler_seconds)):
+        slowest = sorted(((histogram.percentile(99), labels[0], histogram) for labels, histogram in list(family.children.items()) if histogram.count),
+                         key=lambda item: item[0], reverse=True)[:5]
+        if slowest:
+            lines.append("")
+            lines.append(title)
+            lines.extend(f"  {name}: {describe_latency(histogram)}" for _, name, histogram in slowest)
+    await update.message.reply_text(escape_markdownv2("\n".join(lines)), parse_mode="MarkdownV2")
+
+#                                            NEWS SCHEDULER
+
+NEWS_MIN_INTERVAL = float(os.getenv("NEWS_MIN_INTERVAL", "120")) # Seconds between checks of a source while it keeps publishing
+NEWS_MAX_INTERVAL = float(os.getenv("NEWS_MAX_INTERVAL", "900")) # Seconds between checks of a quiet source
+NEWS_ERROR_BACKOFF = float(os.getenv("NEWS_ERROR_BACKOFF", "3600")) # Longest wait after repeated failures
+NEWS_JITTER = float(os.getenv("NEWS_JITTER", "0.1")) # Random +-share of every wait, so the sources don't line up
+SHUTDOWN_DRAIN_TIMEOUT = float(os.getenv("SHUTDOWN_DRAIN_TIMEOUT", "10")) # Seconds queued messages get to go out on shutdown
+
+# Polling interval of one source: it halves while new articles keep appearing and grows by half while nothing changes.
+# Failures back off exponentially from the shortest interval
+class SourceSchedule:
+    def __init__(self, source, min_interval=NEWS_MIN_INTERVAL, max_interval=NEWS_MAX_INTERVAL, max_backoff=NEWS_ERROR_BACKOFF):
+        self.source = source
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.max_backoff = max_backoff
+        self.interval = min_interval
+        self.failures = 0
+
+    # Seconds until the next check, `new_articles` is the result of run_source
+    def next_delay(self, new_articles):
+        if new_articles is None:
+            self.failures += 1
+            delay = min(self.max_backoff, self.min_interval * 2 ** self.failures)
+        else:
+            self.failures = 0
+            if new_articles:
+                self.interval = max(self.min_interval, self.interval / 2)
+            else:
+                self.interval = min(self.max_interval, self.interval * 1.5)
+            delay = self.interval
+        return delay * random.uniform(1 - NEWS_JITTER, 1 + NEWS_JITTER)
+
+source_schedules = {source: SourceSchedule(source) for source in NEWS_SOURCES}
+
+metric("newsbot_news_source_interval_seconds", "gauge", "Current polling interval of the source",
+       ("source",), collect=lambda: {(source, ): schedule.interval for source, schedule in source_schedules.items()})
+
+# Function to check one source for new articles on its own schedule until it is cancelled
+async def poll_source(schedule):
+    await asyncio.sleep(random.uniform(0, NEWS_JITTER * schedule.min_interval)) # Spreading the first checks
     while True:
-        await print_latest_news()
-        await asyncio.sleep(3600)
+        try:
+            new_articles = await check_source(schedule.source)
+        except Exception as e: # A failed run must not stop the source, cancellation still goes through
+            print(f"Error while checking {schedule.source}: {e}")
+            new_articles = None
+        delay = schedule.next_delay(new_articles)
+        if new_articles is None:
+            print(f"Checking {schedule.source} failed {schedule.failures} times in a row, retrying in {delay:.0f} seconds")
+        await asyncio.sleep(delay)
+
+# Function to apply the retention policy once a day
+async def prune_daily():
+    while True:
+        try:
+            await news_prune_old_data()
+        except Exception as e:
+            print(f"Error while pruning old data: {e}")
+        await asyncio.sleep(24 * 3600)
+
+# Function to systematically check websites for new articles and notify users, each source on its own schedule;
+# the first check publishes what a previous run stored but did not fan out
+async def check_news():
+    await asyncio.gather(*(poll_source(schedule) for schedule in source_schedules.values()), prune_daily())
+
+background_tasks = []
+metrics_server = None
+
+# Function to start the metrics endpoint and the background tasks of this process's role once the event loop is running
+async def start_background_tasks(app=None):
+    global metrics_server
+    metrics_server = await start_metrics_server()
+    if has_role("ingest"):
+        background_tasks.append(asyncio.create_task(check_news()))
+        background_tasks.append(asyncio.create_task(daily_digests()))
+    if has_role("sender"):
+        delivery_queue.start()
+        background_tasks.append(asyncio.create_task(job_consumer.run()))
+
+# Function to stop the background tasks, give claimed messages a moment to go out and hand the rest back,
+# then close the HTTP client and the metrics endpoint. The send workers stop before the jobs are handed back,
+# otherwise a job could be handed back while its message is still being sent and another sender would send it again
+async def stop_background_tasks(app=None):
+    for task in background_tasks:
+        task.cancel()
+    await asyncio.gather(*background_tasks, return_exceptions=True)
+    background_tasks.clear()
+    if delivery_queue.queue is not None:
+        try:
+            await asyncio.wait_for(delivery_queue.join(), SHUTDOWN_DRAIN_TIMEOUT)
+        except asyncio.TimeoutError:
+            print(f"{delivery_queue.pending()} queued messages were not sent before shutdown")
+        await delivery_queue.stop()
+        try:
+            await job_consumer.stop()
+        except Exception as e:
+            print(f"Error while handing back delivery jobs, they come back after their lease: {e}")
+    await close_http_client()
+    if metrics_server is not None:
+        metrics_server.close()
+        await metrics_server.wait_closed()
+
+
 #                                                   MAIN APPLICATION
 
+# How updates reach the bot: "polling" asks Telegram for them, "webhook" has Telegram POST them to a local server
+UPDATE_MODE = os.getenv("UPDATE_MODE", "polling")
+# Updates handled at the same time, from different chats: updates of one chat are handled one after the other, in order,
+# because /register and /login keep a conversation state which the next message of the chat is checked against
+UPDATE_CONCURRENCY = int(os.getenv("UPDATE_CONCURRENCY", "32"))
+WEBHOOK_URL = os.getenv("WEBHOOK_URL") # Public HTTPS address Telegram sends updates to, ending with WEBHOOK_PATH
+WEBHOOK_LISTEN = os.getenv("WEBHOOK_LISTEN", "127.0.0.1") # The TLS proxy in front of the bot forwards to this address
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8443"))
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "telegram")
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv("WEBHOOK_MAX_CONNECTIONS", "40")) # Connections Telegram opens to the webhook at most
+# Telegram sends this back in the X-Telegram-Bot-Api-Secret-Token header and requests without it are refused.
+# A random one is registered on every start when none is configured
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET") or secrets.token_urlsafe(32)
+
+# Update processor handling up to `concurrency` updates at the same time but the updates of one chat in order, one at a time.
+# Updates waiting for an earlier one of their chat don't take a slot, so a chat sending many messages can't hold up the others
+class ChatUpdateProcessor(BaseUpdateProcessor):
+    def __init__(self, concurrency):
+        super().__init__(sys.maxsize) # The limit is applied below, after the chat's turn came
+        self.slots = asyncio.Semaphore(concurrency)
+        self.chats = {} # Chat id -> [lock, updates of the chat being handled or waiting]
+
+    async def do_process_update(self, update, coroutine):
+        chat = getattr(update, "effective_chat", None)
+        if chat is None:
+            async with self.slots:
+                await coroutine
+            return
+        chat_entry = self.chats.setdefault(chat.id, [asyncio.Lock(), 0])
+        chat_entry[1] += 1
+        try:
+            async with chat_entry[0], self.slots:
+                await coroutine
+        finally:
+            chat_entry[1] -= 1
+            if not chat_entry[1]:
+                del self.chats[chat.id]
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+# Function to run the roles which don't answer commands until SIGINT or SIGTERM
+async def run_worker():
+    await start_background_tasks()
+    stopping = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for signal_number in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signal_number, stopping.set)
+    print(f"Running as {ROLE}")
+    await stopping.wait()
+    await stop_background_tasks()
+
+# Function to release the executors and the database connections
+def close_resources():
+    db_executor.shutdown()
+    news_executor.shutdown()
+    parse_executor.shutdown()
+    password_executor.shutdown()
+    db_pool.close()
+
 # Function to handle user commands and run the app
 def main():
-    create_tables()
-
-    app = ApplicationBuilder().token(bot.token).build()
+    if ROLE not in ROLES:
+        sys.exit(f"ROLE has to be one of {', '.join(ROLES)}, not {ROLE}")
+    if DEFAULT_DELIVERY_MODE not in DELIVERY_MODES:
+        sys.exit(f"DEFAULT_DELIVERY_MODE has to be one of {', '.join(DELIVERY_MODES)}, not {DEFAULT_DELIVERY_MODE}")
+    migrate_database()
+    if has_role("bot"):
+        rebuild_subscription_index()
+    if has_role("ingest"):
+        warm_seen_links()
+    # The caches loaded above live as long as the process; frozen, the full collections set off by a big fan-out don't walk them
+    gc.collect()
+    gc.freeze()
+    if not has_role("bot"):
+        asyncio.run(run_worker())
+        close_resources()
+        return
+
+    if UPDATE_MODE not in ("polling", "webhook"):
+        sys.exit(f"UPDATE_MODE has to be polling or webhook, not {UPDATE_MODE}")
+    if UPDATE_MODE == "webhook" and not WEBHOOK_URL:
+        sys.exit("WEBHOOK_URL has to be set when UPDATE_MODE is webhook")
+
+    app = (
+        ApplicationBuilder().token(bot.token).base_url(TELEGRAM_API_BASE_URL)
+        .concurrent_updates(ChatUpdateProcessor(UPDATE_CONCURRENCY))
+        .post_init(start_background_tasks).post_shutdown(stop_background_tasks)
+        .build()
+    )
 
     # REGISTER handler
     register_handler = ConversationHandler(
@@ -745,6 +3016,8 @@ def main():
     app.add_handler(CommandHandler("add", add))
     app.add_handler(CommandHandler("remove", remove))
     app.add_handler(CommandHandler("clearpreferences", clearpreferences))
+    app.add_handler(CommandHandler("delivery", delivery))
+    app.add_handler(CommandHandler("stats", stats))
     app.add_handler(CommandHandler("help", commands))
     app.add_handler(CommandHandler("cancel", cancel))
 
@@ -756,12 +3029,19 @@ def main():
     app.add_handler(MessageHandler(filters.COMMAND, unknown_command))
     app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, unknown_message))
 
-
-    # Background task
-    loop = asyncio.get_event_loop()
-    loop.create_task(check_news())
-
-    app.run_polling()
+    # On shutdown both stop taking updates first, then wait for the handlers which are still running
+    if UPDATE_MODE == "webhook":
+        app.run_webhook(
+            listen=WEBHOOK_LISTEN,
+            port=WEBHOOK_PORT,
+            url_path=WEBHOOK_PATH,
+            webhook_url=WEBHOOK_URL,
+            secret_token=WEBHOOK_SECRET,
+            max_connections=WEBHOOK_MAX_CONNECTIONS,
+        )
+    else:
+        app.run_polling()
+    close_resources()
 
 if __name__ == "__main__":
     main()
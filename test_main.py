@@ -0,0 +1,485 @@
+# Regression tests of main.py; run with `python -m pytest test_main.py`
+
+import asyncio
+import os
+from types import SimpleNamespace
+
+import httpx
+import pytest
+
+os.environ.setdefault("TELEGRAM_BOT_TOKEN", "0:test") # main.py creates a Bot when imported
+
+import main
+
+
+#                                               SUBSCRIPTION INDEX
+
+def test_subscription_index_grows_past_initial_columns_on_rebuild():
+    subjects = [f"Subject {number}" for number in range(100)]
+    index = main.SubscriptionIndex(rows=4, columns=2)
+    index.rebuild([(1, "reader", "Reader", "instant")], [("reader", subject) for subject in subjects])
+    assert [len(found) for found in index.match(subjects)] == [1] * len(subjects)
+
+def test_subscription_index_grows_when_a_session_or_preference_adds_subjects():
+    index = main.SubscriptionIndex(rows=4, columns=2)
+    index.add_session(1, "reader", "Reader", ["UK", "World", "Business"], "instant")
+    index.add_preference("reader", "Science")
+    index.add_preference("reader", "Health")
+    subjects = ["UK", "World", "Business", "Science", "Health"]
+    assert index.match(subjects) == [[(1, "Reader", "instant")]] * len(subjects)
+
+
+#                                               DELIVERY QUEUE
+
+def test_delivery_queue_keeps_the_order_of_each_chat(monkeypatch):
+    sent = []
+    attempts = {}
+
+    async def send_message(chat_id, text, parse_mode):
+        attempts[text] = attempts.get(text, 0) + 1
+        if text == "a1" and attempts[text] == 1:
+            raise main.NetworkError("connection reset") # a2 and a3 have to wait for the retry
+        sent.append((chat_id, text))
+
+    monkeypatch.setattr(main, "bot", SimpleNamespace(send_message=send_message))
+    queue = main.DeliveryQueue(workers=4, global_rate=1000, chat_rate=20, max_attempts=3)
+    send = queue._send
+    async def send_with_short_backoff(delivery):
+        retry_in = await send(delivery)
+        return None if retry_in is None else 0.05
+    monkeypatch.setattr(queue, "_send", send_with_short_backoff)
+
+    async def run():
+        queue.start()
+        for number in range(4):
+            queue.put(1, f"a{number}")
+            queue.put(2, f"b{number}")
+        await asyncio.wait_for(queue.join(), 10)
+        await queue.stop()
+
+    asyncio.run(run())
+    assert [text for chat_id, text in sent if chat_id == 1] == ["a0", "a1", "a2", "a3"]
+    assert [text for chat_id, text in sent if chat_id == 2] == ["b0", "b1", "b2", "b3"]
+    assert queue.pending() == 0
+
+
+#                                               UPDATES
+
+def test_updates_of_one_chat_are_handled_in_order_and_other_chats_go_on(monkeypatch):
+    processor = main.ChatUpdateProcessor(concurrency=4)
+    events = []
+
+    async def handle(chat_id, number, seconds):
+        events.append(("start", chat_id, number))
+        await asyncio.sleep(seconds)
+        events.append(("end", chat_id, number))
+
+    def update(chat_id):
+        return SimpleNamespace(effective_chat=SimpleNamespace(id=chat_id))
+
+    async def run():
+        tasks = [asyncio.create_task(processor.process_update(update(1), handle(1, number, 0.05 - number * 0.02))) for number in range(3)]
+        tasks.append(asyncio.create_task(processor.process_update(update(2), handle(2, 0, 0))))
+        await asyncio.gather(*tasks)
+
+    asyncio.run(run())
+    chat_1 = [event for event in events if event[1] == 1]
+    assert chat_1 == [(kind, 1, number) for number in range(3) for kind in ("start", "end")]
+    assert events.index(("end", 2, 0)) < events.index(("end", 1, 0)) # Chat 2 didn't wait for chat 1
+    assert processor.chats == {}
+
+
+#                                               NEWS SOURCES
+
+BBC_ITEM = ('<li><a href="/news/articles/{number}"><p>Headline {number}</p></a>'
+            '<span class="ssrcss-1pvwv4b-MetadataSnippet e4wm5bw3">UK</span></li>')
+
+# Function to build a BBC front page listing the stories with the given numbers, top first
+def bbc_page(numbers):
+    items = "".join(BBC_ITEM.format(number=number) for number in numbers)
+    return f'<html><body><ul class="{main.NEWS_SOURCES["BBC"].list_class}">{items}</ul></body></html>'.encode()
+
+def test_page_is_checked_again_when_its_articles_could_not_be_stored(monkeypatch):
+    page = bbc_page([1, 2, 3])
+    def answer(request):
+        if request.headers.get("If-None-Match") == '"v1"':
+            return httpx.Response(304)
+        return httpx.Response(200, content=page, headers={"ETag": '"v1"'})
+    stored = []
+    async def insert_articles(articles):
+        if not stored:
+            stored.append(None)
+            raise RuntimeError("Deadlock found when trying to get lock")
+        return articles
+    async def parse_articles(name, content):
+        return main.parse_articles(name, content)
+    async def fan_out(articles):
+        pass
+    monkeypatch.setattr(main, "http_client", httpx.AsyncClient(transport=httpx.MockTransport(answer)))
+    monkeypatch.setattr(main, "news_insert_articles", insert_articles)
+    monkeypatch.setattr(main, "news_parse_articles", parse_articles)
+    monkeypatch.setattr(main, "fan_out", fan_out)
+    monkeypatch.setitem(main.source_state, "BBC", {})
+
+    async def run():
+        with pytest.raises(RuntimeError):
+            await main.run_source("BBC")
+        first_retry = await main.run_source("BBC")
+        unchanged = await main.run_source("BBC")
+        return first_retry, unchanged
+
+    assert asyncio.run(run()) == (3, 0)
+
+def test_stored_articles_whose_fan_out_failed_are_published_at_the_next_check(monkeypatch):
+    def answer(request):
+        return httpx.Response(200, content=bbc_page([1, 2, 3]))
+    stored = {} # Link -> (article, whether it was fanned out)
+    async def insert_articles(articles):
+        new_articles = [article for article in articles if article.link not in stored]
+        for article in new_articles:
+            article.id = len(stored) + 1
+            stored[article.link] = [article, False]
+        return new_articles
+    async def get_unpublished_articles():
+        return [article for article, fanned_out in stored.values() if not fanned_out]
+    async def parse_articles(name, content):
+        return main.parse_articles(name, content)
+    published = []
+    async def fan_out(articles):
+        if not published:
+            published.append(None)
+            raise RuntimeError("Lost connection to MySQL server during query")
+        for article in articles:
+            stored[article.link][1] = True
+            published.append(article.link)
+    monkeypatch.setattr(main, "http_client", httpx.AsyncClient(transport=httpx.MockTransport(answer)))
+    monkeypatch.setattr(main, "seen_links", main.SeenLinks(capacity=1000, recent=100))
+    monkeypatch.setattr(main, "news_insert_articles", insert_articles)
+    monkeypatch.setattr(main, "news_get_unpublished_articles", get_unpublished_articles)
+    monkeypatch.setattr(main, "news_parse_articles", parse_articles)
+    monkeypatch.setattr(main, "fan_out", fan_out)
+    monkeypatch.setattr(main, "fan_out_pending", False)
+    monkeypatch.setitem(main.source_state, "BBC", {})
+
+    async def run():
+        with pytest.raises(RuntimeError):
+            await main.check_source("BBC")
+        return await main.check_source("BBC") # The page lists nothing new now
+
+    assert asyncio.run(run()) == 0
+    assert published[1:] == [f"https://www.bbc.co.uk/news/articles/{number}" for number in (1, 2, 3)]
+    assert main.fan_out_pending is False
+
+def test_stories_below_a_lead_story_which_stays_on_top_are_found(monkeypatch):
+    monkeypatch.setattr(main, "seen_links", main.SeenLinks(capacity=1000, recent=100))
+    for number in (1, 2, 3, 4): # The previous cycle listed [1, 2, 3, 4]
+        main.seen_links.add(main.link_hash(f"https://www.bbc.co.uk/news/articles/{number}"))
+    articles, problem = main.parse_articles("BBC", bbc_page([1, 5, 2, 3, 4]))
+    assert problem is None
+    fresh = [article.link for article in articles if not main.seen_links.check(main.link_hash(article.link))]
+    assert fresh == ["https://www.bbc.co.uk/news/articles/5"]
+
+
+#                                               ARTICLE STORAGE
+
+# Stand-in for a MySQL connection which knows a few subjects and seen links and fails the articles INSERT
+class FakeConnection:
+    def __init__(self, subjects, seen, fail_articles=False):
+        self.subjects = subjects # Name -> id
+        self.seen = seen # Link hashes
+        self.fail_articles = fail_articles
+        self.committed = False
+
+    def start_transaction(self):
+        pass
+
+    def commit(self):
+        self.committed = True
+
+    def cursor(self):
+        return FakeCursor(self)
+
+class FakeCursor:
+    def __init__(self, connection):
+        self.connection = connection
+        self.rows = []
+        self.rowcount = 0
+
+    def execute(self, query, parameters=()):
+        if query.startswith('INSERT IGNORE INTO subjects'):
+            added = [name for name in parameters if name not in self.connection.subjects]
+            for name in added:
+                self.connection.subjects[name] = 100 + len(self.connection.subjects)
+            self.rowcount = len(added)
+        elif query.startswith('SELECT id, name FROM subjects'):
+            self.rows = [(self.connection.subjects[name], name) for name in parameters if name in self.connection.subjects]
+        elif query.startswith('SELECT link_hash FROM seen_links'):
+            self.rows = [(hashed,) for hashed in parameters if hashed in self.connection.seen]
+        elif query.startswith('INSERT IGNORE INTO seen_links'):
+            self.rowcount = len([hashed for hashed in parameters if hashed not in self.connection.seen])
+        elif query.startswith('INSERT INTO articles'):
+            if self.connection.fail_articles:
+                raise main.mysql.connector.errors.DataError("Data too long for column 'title'")
+        elif query.startswith('SELECT id, link FROM articles'):
+            self.rows = [(number, link) for number, link in enumerate(parameters, 1)]
+
+    def fetchall(self):
+        return self.rows
+
+    def close(self):
+        pass
+
+def use_connection(monkeypatch, connection):
+    @main.contextmanager
+    def db_connection():
+        yield connection
+    monkeypatch.setattr(main, "db_connection", db_connection)
+    monkeypatch.setattr(main, "seen_links", main.SeenLinks(capacity=1000, recent=100))
+    monkeypatch.setattr(main, "subject_ids", main.LRUCache(100))
+
+def test_subject_ids_are_not_cached_when_the_batch_is_rolled_back(monkeypatch):
+    use_connection(monkeypatch, FakeConnection({}, set(), fail_articles=True))
+    article = main.Article("Headline", "New subject", "1h ago", "https://www.bbc.co.uk/news/articles/1", "BBC")
+    with pytest.raises(main.mysql.connector.Error):
+        main.insert_articles([article])
+    assert main.subject_ids.get("New subject") is None
+    assert main.seen_links.check(main.link_hash(article.link)) is False
+
+def test_batch_is_stored_again_when_another_writer_raced_for_a_link(monkeypatch):
+    link = "https://www.bbc.co.uk/news/articles/1"
+    connection = FakeConnection({"UK": 1}, set())
+    use_connection(monkeypatch, connection)
+    raced = [False]
+    execute = FakeCursor.execute
+    def racing_execute(cursor, query, parameters=()):
+        if query.startswith('INSERT IGNORE INTO seen_links') and not raced[0]:
+            raced[0] = True
+            connection.seen.add(main.link_hash(link)) # Committed by the other writer just before
+        execute(cursor, query, parameters)
+    monkeypatch.setattr(FakeCursor, "execute", racing_execute)
+    articles = [main.Article("Headline", "UK", "1h ago", link, "BBC"),
+                main.Article("Other", "UK", "2h ago", "https://www.bbc.co.uk/news/articles/2", "BBC")]
+    assert [article.link for article in main.insert_articles(articles)] == ["https://www.bbc.co.uk/news/articles/2"]
+    assert main.subject_ids.get("UK") == 1
+
+
+#                                               DELIVERY LEDGER
+
+# Stand-in for a MySQL connection holding the articles' fanned_out flags, the ledger and a job counter; a transaction's
+# writes are applied on commit, and the commit numbered `fail_commit` is lost
+class LedgerConnection:
+    def __init__(self, article_ids, fail_commit=None):
+        self.fanned_out = {article_id: False for article_id in article_ids}
+        self.deliveries = {} # (article id, telegram id) -> job id
+        self.jobs = 0
+        self.commits = 0
+        self.fail_commit = fail_commit
+        self.staged = None
+
+    def start_transaction(self):
+        self.staged = ({}, [])
+
+    def commit(self):
+        self.commits += 1
+        if self.commits == self.fail_commit:
+            raise main.mysql.connector.errors.OperationalError("Lost connection to MySQL server during query")
+        self.deliveries.update(self.staged[0])
+        for article_id in self.staged[1]:
+            self.fanned_out[article_id] = True
+
+    def rollback(self):
+        self.staged = None
+
+    def cursor(self):
+        return LedgerCursor(self)
+
+class LedgerCursor:
+    def __init__(self, connection):
+        self.connection = connection
+        self.rows = []
+        self.lastrowid = None
+
+    def execute(self, query, parameters=()):
+        query = query.strip()
+        if query.startswith('SELECT id FROM articles'):
+            self.rows = [(article_id,) for article_id in parameters if not self.connection.fanned_out[article_id]]
+        elif query.startswith('SELECT article_id, telegram_id FROM deliveries'):
+            self.rows = [pair for pair in self.connection.deliveries if pair[0] in parameters and (pair[1] in parameters or 'telegram_id IN' not in query)]
+        elif query.startswith('INSERT INTO delivery_jobs'):
+            self.lastrowid = self.connection.jobs + 1
+            self.connection.jobs += len(parameters) // 4
+        elif query.startswith('INSERT INTO deliveries'):
+            for start in range(0, len(parameters), 4):
+                article_id, telegram_id, job_id, _ = parameters[start:start + 4]
+                self.connection.staged[0][(article_id, telegram_id)] = job_id
+        elif query.startswith('UPDATE articles SET fanned_out'):
+            self.connection.staged[1].extend(parameters)
+
+    def fetchall(self):
+        return self.rows
+
+    def close(self):
+        pass
+
+def test_interrupted_fan_out_is_finished_for_the_sessions_it_missed(monkeypatch):
+    monkeypatch.setattr(main, "FAN_OUT_CHUNK", 2)
+    connection = LedgerConnection([1, 2], fail_commit=3)
+    use_connection(monkeypatch, connection)
+    subscribers = [(100 + number, f"Reader {number}", "digest") for number in range(5)]
+    monkeypatch.setattr(main, "subscription_index", SimpleNamespace(match=lambda names: [subscribers for _ in names]))
+    articles = []
+    for article_id in (1, 2):
+        article = main.Article(f"Headline {article_id}", "UK", "1h ago", f"https://www.bbc.co.uk/news/articles/{article_id}", "BBC")
+        article.id = article_id
+        articles.append(article)
+
+    jobs, waiting = main.build_fan_out(articles)
+    with pytest.raises(main.mysql.connector.Error):
+        main.publish_fan_out([1, 2], jobs, waiting) # The last chunk of sessions is lost
+    assert len(connection.deliveries) == 8 and not any(connection.fanned_out.values())
+    with pytest.raises(main.LedgerRace):
+        main.publish_fan_out([1, 2], jobs, waiting)
+
+    jobs, waiting = main.build_fan_out(articles, main.get_delivered_pairs([1, 2]))
+    assert [job[0] for job in jobs] == [104]
+    assert main.publish_fan_out([1, 2], jobs, waiting) == set()
+    assert len(connection.deliveries) == 10 and all(connection.fanned_out.values())
+    assert main.publish_fan_out([1, 2], jobs, waiting) == {1, 2}
+
+
+#                                               MIGRATIONS
+
+def test_every_migration_step_can_run_twice():
+    for version, _, steps in main.MIGRATIONS:
+        for step in steps:
+            if callable(step):
+                continue
+            statement = " ".join(step.split()).upper()
+            assert not statement.startswith("ALTER TABLE"), f"migration {version}: {statement}"
+            assert not statement.startswith("DROP TABLE") or statement.startswith("DROP TABLE IF EXISTS"), f"migration {version}: {statement}"
+            assert not statement.startswith("CREATE TABLE") or statement.startswith("CREATE TABLE IF NOT EXISTS"), f"migration {version}: {statement}"
+
+# Cursor answering information_schema lookups from a set of existing names and recording the other statements
+class SchemaCursor:
+    def __init__(self, existing):
+        self.existing = existing
+        self.count = 0
+        self.executed = []
+
+    def execute(self, query, parameters=()):
+        if "information_schema" in query:
+            self.count = int(parameters[-1] in self.existing)
+        else:
+            self.executed.append(query)
+
+    def fetchone(self):
+        return (self.count,)
+
+def test_guarded_steps_skip_what_a_failed_run_already_applied():
+    cursor = SchemaCursor({"user_subject", "ingested_at"})
+    for step in (main.add_index('user_preferences', 'user_subject', 'username, subject_id', unique=True),
+                 main.add_index('user_preferences', 'subject_user', 'subject_id, username'),
+                 main.add_column('articles', 'ingested_at', 'TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP'),
+                 main.if_table_exists('daily_digest_items', 'SELECT 1 FROM daily_digest_items')):
+        step(cursor)
+    assert cursor.executed == ['ALTER TABLE user_preferences ADD INDEX subject_user (subject_id, username)']
+
+# Cursor of a database at schema version 0 whose migration lock is held by another process
+class LockedCursor(SchemaCursor):
+    def __init__(self):
+        super().__init__(set())
+        self.row = None
+
+    def execute(self, query, parameters=()):
+        self.executed.append(query)
+        self.row = (0,) # Version 0, and GET_LOCK timed out
+
+    def fetchone(self):
+        return self.row
+
+    def close(self):
+        pass
+
+def test_migration_does_not_run_without_the_lock(monkeypatch):
+    cursor = LockedCursor()
+    use_connection(monkeypatch, SimpleNamespace(cursor=lambda: cursor))
+    with pytest.raises(RuntimeError):
+        main.migrate_database()
+    assert [query.split()[0] for query in cursor.executed] == ["SELECT", "SELECT"] # The version and GET_LOCK, no DDL
+
+@pytest.mark.skipif(not os.getenv("DB_NAME"), reason="needs a MySQL 8 database configured with DB_HOST, DB_USER, DB_PASSWORD and DB_NAME")
+def test_hot_queries_can_use_their_indexes():
+    main.migrate_database()
+    assert main.check_query_plans() == []
+
+
+#                                               SHUTDOWN
+
+def test_jobs_are_handed_back_only_after_the_send_workers_stopped(monkeypatch):
+    sent = []
+    released = []
+
+    async def send_message(chat_id, text, parse_mode):
+        await asyncio.sleep(0.2) # Still sending when the drain timeout runs out
+        sent.append(text)
+
+    async def finish_jobs(sent_ids, failed_ids):
+        pass
+
+    async def release_jobs(job_ids):
+        released.extend(job_ids)
+        await asyncio.sleep(0.3) # The database call gives a running send time to finish
+
+    async def close_http_client():
+        pass
+
+    monkeypatch.setattr(main, "bot", SimpleNamespace(send_message=send_message))
+    monkeypatch.setattr(main, "news_finish_jobs", finish_jobs)
+    monkeypatch.setattr(main, "news_release_jobs", release_jobs)
+    monkeypatch.setattr(main, "close_http_client", close_http_client)
+    monkeypatch.setattr(main, "SHUTDOWN_DRAIN_TIMEOUT", 0.05)
+    queue = main.DeliveryQueue(workers=1, global_rate=1000, chat_rate=1000, max_attempts=3)
+    consumer = main.JobConsumer(queue, [0])
+    monkeypatch.setattr(main, "delivery_queue", queue)
+    monkeypatch.setattr(main, "job_consumer", consumer)
+
+    async def run():
+        queue.start()
+        consumer.in_flight.add(7)
+        queue.put(1, "message", job_id=7)
+        await asyncio.sleep(0.01)
+        await main.stop_background_tasks()
+
+    asyncio.run(run())
+    assert released == [7] and sent == []
+
+def test_waiting_for_deliveries_counts_only_the_shards_of_this_sender(monkeypatch):
+    counted = []
+    async def count_jobs(shards=None):
+        counted.append(shards)
+        return 0
+    queue = main.DeliveryQueue(workers=1, global_rate=1000, chat_rate=1000, max_attempts=3)
+    monkeypatch.setattr(main, "delivery_queue", queue)
+    monkeypatch.setattr(main, "job_consumer", main.JobConsumer(queue, [1, 3]))
+    monkeypatch.setattr(main, "news_count_jobs", count_jobs)
+
+    async def run():
+        with pytest.raises(RuntimeError): # No sender runs in this process
+            await main.wait_for_deliveries()
+        queue.start()
+        await main.wait_for_deliveries()
+        await queue.stop()
+
+    asyncio.run(run())
+    assert counted == [[1, 3]]
+
+
+#                                               SETTINGS
+
+def test_unknown_default_delivery_mode_stops_the_start(monkeypatch):
+    monkeypatch.setattr(main, "DEFAULT_DELIVERY_MODE", "Instant")
+    def migrate_database():
+        raise AssertionError("the settings are checked before the database is touched")
+    monkeypatch.setattr(main, "migrate_database", migrate_database)
+    with pytest.raises(SystemExit, match="DEFAULT_DELIVERY_MODE"):
+        main.main()